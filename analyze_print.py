@@ -8,6 +8,7 @@ Uses high-quality LLM providers for accurate, reliable analysis.
 Usage:
     python3 analyze_print.py                     # Analyze most recent print
     python3 analyze_print.py <summary.json>      # Analyze specific print
+    python3 analyze_print.py --batch '*'         # Analyze every print in log_dir
     python3 analyze_print.py --auto              # Auto-apply safe suggestions
     python3 analyze_print.py --provider openai   # Use specific provider
     
@@ -21,35 +22,103 @@ Supported providers (use --provider flag):
 """
 
 import os
-import sys
-import json
+import re
 import glob
+import argparse
+import sys
+import io
 import csv
+import json
+import time
+import threading
+import hashlib
+import functools
+import heapq
+import collections
+import random
+import ssl
+import http.client
+import urllib.error
 import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+# orjson is optional - it speeds up JSON parsing and encoding when installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# json5 is optional - it rescues LLM replies with trailing commas, single
+# quotes or unquoted keys. It is much slower, so it is only tried after
+# strict parsing fails
+try:
+    import json5
+except ImportError:
+    json5 = None
+
+
+def json_loads(data):
+    """Parse JSON from str or bytes, with orjson when available."""
+    return orjson.loads(data) if orjson else json.loads(data)
+
+
+def json_dumps_compact(obj):
+    """Encode obj as compact UTF-8 JSON bytes, with orjson when available."""
+    if orjson:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def write_file_atomic(path, data):
+    """Write bytes to path through a temporary file and a rename, so no reader sees it half-written."""
+    # Unique per thread too: --batch workers share one process
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except OSError:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
 # =============================================================================
 # PROVIDER CONFIGURATIONS
 # =============================================================================
 # Only quality LLM providers that produce reliable, accurate analysis
+# max_concurrency/rpm keep batch analysis under each provider's rate limits
 PROVIDERS = {
     'github': {
         'api_url': 'https://models.inference.ai.azure.com/chat/completions',
         'model': 'gpt-4o-mini',
         'key_env': ['GITHUB_TOKEN', 'GH_TOKEN'],
         'format': 'openai',
+        'max_concurrency': 2,
+        'rpm': 15,
+        'max_output_tokens': 4000,
     },
     'openai': {
         'api_url': 'https://api.openai.com/v1/chat/completions',
         'model': 'gpt-4o-mini',
         'key_env': ['OPENAI_API_KEY'],
         'format': 'openai',
+        'max_concurrency': 8,
+        'rpm': 500,
+        'max_output_tokens': 16000,
+        'batch_url': 'https://api.openai.com/v1/batches',  # for --batch-api
     },
     'anthropic': {
         'api_url': 'https://api.anthropic.com/v1/messages',
         'model': 'claude-3-haiku-20240307',
         'key_env': ['ANTHROPIC_API_KEY'],
         'format': 'anthropic',
+        'max_concurrency': 4,
+        'rpm': 50,
+        'max_output_tokens': 4096,
     },
 }
 
@@ -72,116 +141,583 @@ CONFIG = {
     # Analysis settings
     'analyze_klippy_log': True,
     'max_csv_rows': 100,
+    
+    # Cached LLM responses older than this are ignored (0 = never expire)
+    'cache_ttl_days': 30,
+    # Also reuse the analysis of a previous print with near-identical statistics
+    'similar_cache': False,
+    
+    # Batch limits - simultaneous LLM requests and requests per minute (0 = no limit)
+    # Set from the provider defaults by configure_provider()
+    'max_concurrency': 4,
+    'rpm': 0,
+    'max_output_tokens': 4000,  # caps the response size for --pack
 }
 
 
-def load_config_file():
-    """Load settings from analysis_config.cfg if it exists."""
-    config_paths = [
-        os.path.join(os.path.dirname(__file__), 'analysis_config.cfg'),
-        os.path.expanduser('~/Klipper-Adaptive-Flow/analysis_config.cfg'),
-        os.path.expanduser('~/printer_data/config/analysis_config.cfg'),
-    ]
-    
-    for config_path in config_paths:
-        if os.path.exists(config_path):
+class RequestLimiter:
+    """Space out LLM requests so a batch stays under the provider's rate limit.
+    
+    Each caller reserves the next free slot (60/rpm seconds apart) and sleeps
+    until it arrives, which avoids 429 responses instead of retrying them.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._next_slot = 0.0
+    
+    def wait(self, rpm):
+        if not rpm:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + 60.0 / rpm
+        if slot > now:
+            time.sleep(slot - now)
+
+
+_request_limiter = RequestLimiter()
+
+
+@functools.lru_cache(maxsize=1)
+def _ssl_context():
+    """Return the TLS context shared by every HTTPS request (CA bundle loaded once)."""
+    return ssl.create_default_context()
+
+
+@functools.lru_cache(maxsize=None)
+def _proxied(scheme, netloc):
+    """True if HTTP_PROXY/HTTPS_PROXY applies to scheme://netloc (NO_PROXY respected)."""
+    return scheme in urllib.request.getproxies() and not urllib.request.proxy_bypass(netloc)
+
+
+class ConnectionPool:
+    """Keep one HTTP(S) connection per thread and host open between requests.
+    
+    Analyzing several prints reuses the TCP/TLS connection to the provider
+    (and applying suggestions the one to Moonraker) instead of paying a new
+    handshake for every request. Non-2xx responses raise
+    urllib.error.HTTPError, like urllib.request.urlopen.
+    
+    Hosts reached through HTTP_PROXY/HTTPS_PROXY are not pooled: those
+    requests go through urllib.request.urlopen, which handles the proxy.
+    Pooled requests don't follow redirects - the provider and Moonraker
+    endpoints answer directly (and urlopen would turn a redirected POST
+    into a GET without its body anyway).
+    """
+    
+    def __init__(self):
+        self._local = threading.local()
+    
+    def _urlopen(self, method, url, body, headers, timeout):
+        """Send a request through a proxy with urlopen and return the response."""
+        request = urllib.request.Request(url, data=body, headers=headers or {}, method=method)
+        return urllib.request.urlopen(request, timeout=timeout, context=_ssl_context())
+    
+    def _open(self, method, url, body, headers, timeout, retry=True):
+        """Send a request and return (key, conn, response) with the body still unread.
+        
+        A request that fails on a reused connection the server had already
+        closed is resent once on a new one. With retry=False the request
+        always goes out on a new connection and is never resent.
+        """
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path + (f"?{parts.query}" if parts.query else '')
+        connections = self._local.__dict__.setdefault('connections', {})
+        
+        while True:
+            conn = connections.pop(key, None)
+            if conn is not None and not retry:
+                conn.close()
+                conn = None
+            reused = conn is not None
+            if not reused:
+                if parts.scheme == 'https':
+                    conn = http.client.HTTPSConnection(parts.netloc, timeout=timeout,
+                                                       context=_ssl_context())
+                else:
+                    conn = http.client.HTTPConnection(parts.netloc, timeout=timeout)
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
             try:
-                with open(config_path, 'r') as f:
-                    for line in f:
-                        line = line.strip()
-                        if not line or line.startswith('#') or line.startswith('['):
-                            continue
-                        if ':' in line:
-                            key, value = line.split(':', 1)
-                            key = key.strip()
-                            value = value.strip()
-                            
-                            # Skip empty values
-                            if not value:
-                                continue
-                            
-                            # Parse booleans
-                            if value.lower() == 'true':
-                                value = True
-                            elif value.lower() == 'false':
-                                value = False
-                            elif value.isdigit():
-                                value = int(value)
-                            
-                            # Map config keys to CONFIG dict
-                            if key == 'api_key':
-                                CONFIG['api_key'] = value
-                            elif key == 'model':
-                                CONFIG['model'] = value
-                            elif key == 'moonraker_url':
-                                CONFIG['moonraker_url'] = value
-                            elif key == 'log_dir':
-                                CONFIG['log_dir'] = os.path.expanduser(value)
-                            elif key == 'analyze_klippy_log':
-                                CONFIG['analyze_klippy_log'] = value
-                            elif key == 'max_csv_rows' and isinstance(value, int):
-                                CONFIG['max_csv_rows'] = value
+                conn.request(method, path, body=body, headers=headers or {})
+                return key, conn, conn.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                conn.close()
+                if reused:
+                    continue  # Server closed the idle connection - reconnect once
+                raise
+            except Exception:
+                conn.close()
+                raise
+    
+    def _release(self, key, conn, response):
+        """Keep conn for the next request to the same host unless the server is closing it."""
+        if response.will_close:
+            conn.close()
+        else:
+            self._local.connections[key] = conn
+    
+    def _read(self, key, conn, response, url):
+        """Read the whole response body, raising HTTPError for an error status."""
+        try:
+            data = response.read()
+        except Exception:
+            conn.close()
+            raise
+        self._release(key, conn, response)
+        if response.status >= 400:
+            raise urllib.error.HTTPError(url, response.status, response.reason,
+                                         response.headers, None)
+        return data
+    
+    def request(self, method, url, body=None, headers=None, timeout=60, retry=True):
+        """Send a request and return the response body bytes.
+        
+        Pass retry=False for requests that must not be sent twice (see _open).
+        """
+        parts = urllib.parse.urlsplit(url)
+        if _proxied(parts.scheme, parts.netloc):
+            with self._urlopen(method, url, body, headers, timeout) as response:
+                return response.read()
+        key, conn, response = self._open(method, url, body, headers, timeout, retry)
+        return self._read(key, conn, response, url)
+    
+    def stream(self, method, url, body=None, headers=None, timeout=60):
+        """Send a request and return an iterator over the response body lines.
+        
+        For server-sent events: timeout bounds the wait for each line rather
+        than the whole response. An error status raises HTTPError here,
+        before anything is iterated.
+        """
+        parts = urllib.parse.urlsplit(url)
+        if _proxied(parts.scheme, parts.netloc):
+            return self._iter_proxied_lines(self._urlopen(method, url, body, headers, timeout))
+        key, conn, response = self._open(method, url, body, headers, timeout)
+        if response.status >= 400:
+            self._read(key, conn, response, url)
+        return self._iter_lines(key, conn, response)
+    
+    def _iter_proxied_lines(self, response):
+        """Yield the lines of a urlopen response, then close it."""
+        with response:
+            yield from iter(response.readline, b'')
+    
+    def _iter_lines(self, key, conn, response):
+        """Yield response lines, then hand the connection back for reuse."""
+        try:
+            for line in iter(response.readline, b''):
+                yield line
+        except BaseException:
+            conn.close()  # Abandoned mid-stream - the connection can't be reused
+            raise
+        self._release(key, conn, response)
+
+
+_connections = ConnectionPool()
+
+# Retries for rate-limited (429), timed-out (408) and server-error (5xx) responses,
+# timeouts and dropped connections
+RETRY_ATTEMPTS = 5
+RETRY_MAX_DELAY_S = 30
+# Timeout for one attempt, and for all attempts of a request together - the
+# Moonraker hook kills the analyzer after 120 s, so this leaves it time to finish
+REQUEST_TIMEOUT_S = 60
+RETRY_DEADLINE_S = 90
+# --stream gives up if the provider sends nothing for this long
+LLM_STREAM_IDLE_TIMEOUT_S = 20
+
+
+def request_with_retry(method, url, body=None, headers=None, stream=False, rpm=None):
+    """Send a request through the connection pool, retrying transient failures.
+    
+    HTTP 408/429/5xx, timeouts and dropped connections are retried with
+    exponential backoff and full jitter between attempts, or after the
+    server's Retry-After hint when it sends one, as long as the retry fits in
+    RETRY_DEADLINE_S. A timed-out POST may still be running (and billed) at
+    the provider, so it is retried once at most. With rpm, every attempt
+    first waits for its RequestLimiter slot. Other errors, and the last
+    failure, are raised to the caller. With stream=True, returns an iterator
+    over the response lines (see ConnectionPool.stream).
+    """
+    deadline = None
+    post_timeouts = 0
+    for attempt in range(RETRY_ATTEMPTS):
+        _request_limiter.wait(rpm)
+        now = time.monotonic()
+        if deadline is None:
+            deadline = now + RETRY_DEADLINE_S  # Waiting for the first slot doesn't count
+        try:
+            if stream:
+                return _connections.stream(method, url, body, headers, timeout=LLM_STREAM_IDLE_TIMEOUT_S)
+            timeout = max(1.0, min(REQUEST_TIMEOUT_S, deadline - now))
+            return _connections.request(method, url, body, headers, timeout=timeout)
+        except (TimeoutError, ConnectionError, urllib.error.URLError) as e:
+            if isinstance(e, urllib.error.HTTPError):
+                if not (e.code in (408, 429) or e.code >= 500):
+                    raise
+                retry_after = e.headers.get('Retry-After', '') if e.headers else ''
+                if retry_after.isdigit():
+                    delay = min(float(retry_after), RETRY_MAX_DELAY_S)
+                else:
+                    delay = random.uniform(0, min(RETRY_MAX_DELAY_S, 2 ** attempt))
+            else:
+                # socket.timeout is TimeoutError; RemoteDisconnected is a ConnectionError.
+                # Proxied requests go through urlopen, which wraps them in URLError
+                reason = getattr(e, 'reason', e)
+                if not isinstance(reason, (TimeoutError, ConnectionError)):
+                    raise
+                if isinstance(reason, TimeoutError) and method != 'GET':
+                    post_timeouts += 1
+                    if post_timeouts > 1:
+                        raise
+                delay = random.uniform(0, min(RETRY_MAX_DELAY_S, 2 ** attempt))
+            slot_gap = 60.0 / rpm if rpm else 0.0  # Worst-case wait for the next limiter slot
+            if attempt == RETRY_ATTEMPTS - 1 or time.monotonic() + delay + slot_gap >= deadline:
+                raise
+            print(f"API Error: {e} - retrying in {delay:.1f}s")
+        time.sleep(delay)
+
+# Sampling temperature: the analysis should be reproducible, so that a cached
+# response is as good as a fresh one
+LLM_TEMPERATURE = 0.0
+
+# Output budget for one print's analysis - the JSON response (issues plus
+# suggestions) stays well under this, and packed requests scale it per print
+LLM_MAX_TOKENS = 2000
+
+# How often to check on a submitted --batch-api job
+BATCH_POLL_INTERVAL_S = 30
 
+# CSV columns sent to the LLM - keep in sync with the Columns line in PRINT_DATA_TEMPLATE
+CSV_COLUMNS = ('elapsed_s', 'temp_actual', 'temp_target', 'boost', 'flow', 'speed', 'pwm', 'pa',
+               'z_height', 'predicted_flow', 'dynz_active', 'accel', 'fan_pct')
+
+# Summary fields sent to the LLM. The per-feature sections already hold the
+# legacy flat fields under the same names, so those copies (and the file
+# name/timestamps) are dropped; dynz_active_pct is kept as the guidelines use it
+LLM_FIELDS = ('material', 'duration_min', 'samples', 'features', 'auto_temp', 'heater', 'flow',
+              'dynamic_pa', 'dynamic_z', 'smart_cooling', 'dynz_active_pct')
+
+# Summary statistics compared by the similar-print cache (similar_cache: true)
+SIMILAR_FEATURES = ('duration_min', 'avg_boost', 'max_boost', 'avg_pwm', 'max_pwm', 'avg_flow',
+                    'max_flow', 'max_speed', 'avg_thermal_lag', 'dynz_active_pct', 'fan_avg')
+SIMILAR_CACHE_THRESHOLD = 0.95
+
+# klippy.log lines included in the prompt
+MAX_KLIPPY_ISSUES = 30
+
+# klippy.log span left to scan line by line after seeking to the print start
+KLIPPY_SEEK_SPAN = 64 * 1024
+
+# Lowercase substrings, one of which every klippy.log issue pattern contains
+KLIPPY_FAST_TOKENS = ('!!', 'thermal', 'heater', 'temp', 'timer too close', 'mcu', 'stepper',
+                      'tmc', 'driver', 'pause', 'shutdown', 'lost communication', 'overdue')
+
+# klippy.log issue keywords, matched against the lowercased line: plain
+# substrings, plus the few patterns that really need a regex
+KLIPPY_ISSUE_SUBSTRINGS = (
+    '!!',  # Error prefix
+    'thermal',
+    'heater',
+    'timer too close',
+    'stepper',
+    'driver',
+    'pause',
+    'shutdown',
+    'lost communication',
+    'overdue',
+)
+_KLIPPY_ISSUE_RE = re.compile('|'.join([
+    r'temp.*error',
+    r'temp.*warning',
+    r'mcu.*error',
+    r'mcu.*timeout',
+    r'tmc.*error',
+]))
+
+# Bytes read from the end of a print CSV to find its last rows
+CSV_TAIL_WINDOW = 64 * 1024
+
+# CSV sample sent to the LLM: the first CSV_HEAD_ROWS rows of the print, the
+# CSV_PEAK_ROWS highest rows of each CSV_PEAK_COLUMNS column over the whole
+# print, and the last rows up to max_csv_rows in total.
+# A small max_csv_rows shrinks the first and peak rows (at most a fifth and a
+# tenth of it) so most of the sample is always the end of the print
+CSV_HEAD_ROWS = 10
+CSV_PEAK_ROWS = 5
+CSV_PEAK_COLUMNS = ('pwm', 'boost')
+
+# Size limit for one --pack prompt (~4 chars per token, well inside a 128k context)
+MAX_PACKED_PROMPT_CHARS = 200000
+
+
+# Config file locations, in priority order (resolved once at import)
+CONFIG_PATHS = (
+    os.path.join(os.path.dirname(__file__), 'analysis_config.cfg'),
+    os.path.expanduser('~/Klipper-Adaptive-Flow/analysis_config.cfg'),
+    os.path.expanduser('~/printer_data/config/analysis_config.cfg'),
+)
+
+KLIPPY_LOG = os.path.expanduser('~/printer_data/logs/klippy.log')
+
+# "key: value" setting line; comments and [section] headers never match
+_CONFIG_LINE_RE = re.compile(r'\s*([A-Za-z_][A-Za-z0-9_]*)\s*:\s*(.*?)\s*$')
+
+
+@functools.lru_cache(maxsize=4)
+def _read_config_file(config_path, mtime_ns, size):
+    """Parse one config file into a settings dict, or None if it can't be read.
+    
+    mtime_ns and size key the cache, so an unchanged file is parsed only once
+    per process while an edited one is read again.
+    """
+    try:
+        settings = {}
+        with open(config_path, 'r') as f:
+            for line in f:
+                match = _CONFIG_LINE_RE.match(line)
+                if not match:
+                    continue
+                key, value = match.groups()
                 
-                return config_path
-            except Exception as e:
-                print(f"Warning: Failed to load {config_path}: {e}")
+                # Skip empty values
+                if not value:
+                    continue
+                
+                # Parse booleans
+                lowered = value.lower()
+                if lowered == 'true':
+                    value = True
+                elif lowered == 'false':
+                    value = False
+                elif value.isdigit():
+                    value = int(value)
+                
+                settings[key] = value
+        
+        return settings
+    except Exception as e:
+        print(f"Warning: Failed to load {config_path}: {e}")
+        return None
+
+
+def _parsed_config():
+    """Return the settings of the first available analysis_config.cfg.
     
-    return None
+    Returns (config_path, settings) where settings maps every key in the
+    file to its parsed value, or (None, {}) if no config file was found.
+    """
+    for config_path in CONFIG_PATHS:
+        try:
+            st = os.stat(config_path)
+        except OSError:
+            continue
+        settings = _read_config_file(config_path, st.st_mtime_ns, st.st_size)
+        if settings is not None:
+            return config_path, settings
+    
+    return None, {}
+
+
+def _int_setting(value):
+    return value if isinstance(value, int) else None
 
 
-def get_config_provider():
-    """Get provider from config file."""
-    config_paths = [
-        os.path.join(os.path.dirname(__file__), 'analysis_config.cfg'),
-        os.path.expanduser('~/Klipper-Adaptive-Flow/analysis_config.cfg'),
-        os.path.expanduser('~/printer_data/config/analysis_config.cfg'),
-    ]
+# Config file keys copied into CONFIG, with the conversion applied to each
+# value (None means the value is ignored)
+_CONFIG_SETTINGS = {
+    'api_key': lambda value: value,
+    'model': lambda value: value,
+    'moonraker_url': lambda value: value,
+    'log_dir': os.path.expanduser,
+    'report_dir': os.path.expanduser,
+    'analyze_klippy_log': lambda value: value,
+    'max_csv_rows': _int_setting,
+    'cache_ttl_days': _int_setting,
+    'similar_cache': lambda value: value,
+}
+
+
+def load_config_file():
+    """Load settings from analysis_config.cfg if it exists.
     
-    for config_path in config_paths:
-        if os.path.exists(config_path):
-            try:
-                with open(config_path, 'r') as f:
-                    for line in f:
-                        line = line.strip()
-                        if line.startswith('provider:'):
-                            value = line.split(':', 1)[1].strip()
-                            if value and value in PROVIDERS:
-                                return value
-            except:
-                pass
-    return None
+    Applies the known keys to CONFIG and returns (config_path, provider),
+    where provider is the configured provider name if it is a known one.
+    """
+    config_path, settings = _parsed_config()
+    
+    for key, value in settings.items():
+        setting = _CONFIG_SETTINGS.get(key)
+        if setting is None:
+            continue
+        value = setting(value)
+        if value is not None:
+            CONFIG[key] = value
+    
+    provider = settings.get('provider')
+    return config_path, provider if provider in PROVIDERS else None
+
+
+def _cache_key(summary_bytes, csv_sample, klippy_issues, model, prompt_version):
+    """Build a content hash identifying one LLM request."""
+    h = hashlib.sha256()
+    for part in (summary_bytes, csv_sample.encode('utf-8'), (klippy_issues or '').encode('utf-8'),
+                 model.encode('utf-8'), prompt_version.encode('utf-8')):
+        h.update(part)
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+def _cache_dir():
+    """Directory holding the response cache.
+    
+    Kept under log_dir rather than report_dir, which usually sits inside the
+    Klipper config tree that Mainsail shows and users back up.
+    """
+    return os.path.join(CONFIG['log_dir'], '.cache')
+
+
+def _cache_path(key):
+    """Location of a cached LLM response."""
+    return os.path.join(_cache_dir(), f"{key}.json")
+
+
+def load_cached_response(key):
+    """Return the cached LLM response for key, or None if missing or expired."""
+    cache_path = _cache_path(key)
+    try:
+        with open(cache_path, 'rb') as f:
+            ttl_s = CONFIG.get('cache_ttl_days', 30) * 86400
+            if ttl_s and time.time() - os.fstat(f.fileno()).st_mtime > ttl_s:
+                return None
+            return json_loads(f.read()).get('response')
+    except (OSError, ValueError):
+        return None
+
+
+def save_cached_response(key, response):
+    """Store an LLM response so re-analyzing the same print skips the API call."""
+    cache_path = _cache_path(key)
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        write_file_atomic(cache_path, json_dumps_compact(
+            {'cached_at': datetime.now().isoformat(), 'response': response}))
+    except OSError as e:
+        print(f"Warning: Failed to cache LLM response: {e}")
+
+
+def _similarity(a, b):
+    """Similarity of two feature dicts: 1.0 = identical, 0.95 = every field within 5%.
+    
+    A field missing from either dict makes them dissimilar (0.0): sparse
+    summaries would otherwise match on almost nothing.
+    """
+    worst = 0.0
+    for name in SIMILAR_FEATURES:
+        x, y = a.get(name), b.get(name)
+        if x is None or y is None:
+            return 0.0
+        worst = max(worst, abs(x - y) / max(abs(x), abs(y), 1.0))
+    return 1.0 - worst
+
+
+def _similar_index_path():
+    return os.path.join(_cache_dir(), 'similar.jsonl')
+
+
+def _similar_profile(summary):
+    """Fields that must match exactly before two prints are compared numerically."""
+    return [summary.get('material', ''), CONFIG['model'], PROMPT_VERSION]
+
+
+def find_similar_response(summary):
+    """Return a cached response for a near-identical print, or None.
+    
+    Repeated prints of the same part (or tuning iterations that barely change
+    the numbers) rarely produce byte-identical summaries, so the exact cache
+    misses them. This compares the key statistics of previously analyzed
+    prints with the same material and model and reuses the closest analysis
+    when every statistic is within SIMILAR_CACHE_THRESHOLD. A summary missing
+    any of SIMILAR_FEATURES never matches.
+    """
+    features = {name: summary.get(name) for name in SIMILAR_FEATURES}
+    if None in features.values():
+        return None
+    profile = _similar_profile(summary)
+    best_key, best_score = None, SIMILAR_CACHE_THRESHOLD
+    try:
+        with open(_similar_index_path(), 'rb') as f:
+            for line in f:
+                try:
+                    entry = json_loads(line)
+                except ValueError:
+                    continue
+                if entry.get('profile') != profile:
+                    continue
+                score = _similarity(features, entry.get('features', {}))
+                if score >= best_score:
+                    best_key, best_score = entry.get('key'), score
+    except OSError:
+        return None
+    return load_cached_response(best_key) if best_key else None
+
+
+def index_similar_response(key, summary):
+    """Record a cached response so find_similar_response() can match later prints."""
+    entry = {
+        'key': key,
+        'profile': _similar_profile(summary),
+        'features': {name: summary.get(name) for name in SIMILAR_FEATURES},
+    }
+    try:
+        with open(_similar_index_path(), 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+    except OSError as e:
+        print(f"Warning: Failed to index LLM response: {e}")
+
+
+# Divider lines for the text report
+REPORT_EQ = "=" * 70 + "\n"
+REPORT_HR = "-" * 70 + "\n"
 
 
 def save_analysis_results(analysis, summary_file, provider, model):
     """Save analysis results to JSON and human-readable text files."""
     try:
         # Use report_dir if configured, otherwise fall back to log_dir
+        # (both are already expanded when loaded)
         report_dir = CONFIG.get('report_dir', CONFIG['log_dir'])
-        report_dir = os.path.expanduser(report_dir)
         
         # Create report directory if it doesn't exist
         os.makedirs(report_dir, exist_ok=True)
         
+        # One timestamp for the file name, JSON metadata and report header
+        now = datetime.now()
+        source_name = os.path.basename(summary_file) if summary_file else 'N/A'
+        
         # Create analysis filename based on the print summary file
         # IMPORTANT: Must create a DIFFERENT filename to avoid overwriting the original summary
         if summary_file:
-            base_name = os.path.basename(summary_file)
-            # Remove the _summary.json suffix first, then add analysis_ prefix
-            if '_summary.json' in base_name:
-                base_name = base_name.replace('_summary.json', '')
-            else:
-                base_name = base_name.replace('.json', '')
+            base_name = source_name
+            # Remove the _summary.json (or .json) suffix first, then add analysis_ prefix
+            if base_name.endswith('_summary.json'):
+                base_name = base_name[:-len('_summary.json')]
+            elif base_name.endswith('.json'):
+                base_name = base_name[:-len('.json')]
             base_name = f"analysis_{base_name}"
         else:
-            base_name = f"analysis_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+            base_name = f"analysis_{now.strftime('%Y%m%d_%H%M%S')}"
         
         json_file = os.path.join(report_dir, f"{base_name}.json")
         text_file = os.path.join(report_dir, f"{base_name}.txt")
         
         # Add metadata
         result = {
-            'analyzed_at': datetime.now().isoformat(),
+            'analyzed_at': now.isoformat(),
             'provider': provider,
             'model': model,
             'source_file': summary_file,
@@ -189,65 +725,62 @@ def save_analysis_results(analysis, summary_file, provider, model):
         }
         
         # Save JSON
-        with open(json_file, 'w') as f:
-            json.dump(result, f, indent=2)
+        if orjson:
+            with open(json_file, 'wb') as f:
+                f.write(orjson.dumps(result, option=orjson.OPT_INDENT_2))
+        else:
+            with open(json_file, 'w') as f:
+                json.dump(result, f, indent=2)
+        
+        # Save human-readable text report (built in memory, written once)
+        parts = [
+            REPORT_EQ,
+            "ADAPTIVE FLOW PRINT ANALYSIS REPORT\n",
+            REPORT_EQ, "\n",
+            f"Analyzed: {now.strftime('%Y-%m-%d %H:%M:%S')}\n",
+            f"Provider: {provider} ({model})\n",
+            f"Source: {source_name}\n\n",
+            REPORT_HR,
+            "ASSESSMENT\n",
+            REPORT_HR,
+            f"{analysis.get('assessment', 'N/A')}\n\n",
+            f"Quality Prediction: {analysis.get('print_quality_prediction', 'N/A').upper()}\n\n",
+        ]
+        
+        issues = analysis.get('issues', [])
+        if issues:
+            parts += [REPORT_HR, f"ISSUES ({len(issues)})\n", REPORT_HR]
+            for issue in issues:
+                severity = issue.get('severity', 'unknown').upper()
+                parts.append(f"[{severity}] {issue.get('description', '')}\n")
+            parts.append("\n")
+        
+        suggestions = analysis.get('suggestions', [])
+        if suggestions:
+            parts += [REPORT_HR, f"SUGGESTIONS ({len(suggestions)})\n", REPORT_HR]
+            for i, sug in enumerate(suggestions, 1):
+                safe = "SAFE TO AUTO-APPLY" if sug.get('safe_to_auto_apply') else "MANUAL REVIEW REQUIRED"
+                parts += [
+                    f"\n{i}. {sug.get('parameter', 'unknown')}\n",
+                    f"   Current: {sug.get('current', '?')}\n",
+                    f"   Suggested: {sug.get('suggested', '?')}\n",
+                    f"   Reason: {sug.get('reason', '')}\n",
+                    f"   [{safe}]\n",
+                ]
+            parts.append("\n")
+        
+        klippy_concerns = analysis.get('klippy_concerns', '')
+        if klippy_concerns and klippy_concerns.lower() != 'none':
+            parts += [REPORT_HR, "KLIPPER LOG CONCERNS\n", REPORT_HR, f"{klippy_concerns}\n\n"]
+        
+        notes = analysis.get('notes', '')
+        if notes:
+            parts += [REPORT_HR, "NOTES\n", REPORT_HR, f"{notes}\n\n"]
+        
+        parts += [REPORT_EQ, "END OF REPORT\n", REPORT_EQ]
         
-        # Save human-readable text report
         with open(text_file, 'w') as f:
-            f.write("=" * 70 + "\n")
-            f.write("ADAPTIVE FLOW PRINT ANALYSIS REPORT\n")
-            f.write("=" * 70 + "\n\n")
-            f.write(f"Analyzed: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
-            f.write(f"Provider: {provider} ({model})\n")
-            f.write(f"Source: {os.path.basename(summary_file) if summary_file else 'N/A'}\n\n")
-            
-            f.write("-" * 70 + "\n")
-            f.write("ASSESSMENT\n")
-            f.write("-" * 70 + "\n")
-            f.write(f"{analysis.get('assessment', 'N/A')}\n\n")
-            f.write(f"Quality Prediction: {analysis.get('print_quality_prediction', 'N/A').upper()}\n\n")
-            
-            issues = analysis.get('issues', [])
-            if issues:
-                f.write("-" * 70 + "\n")
-                f.write(f"ISSUES ({len(issues)})\n")
-                f.write("-" * 70 + "\n")
-                for issue in issues:
-                    severity = issue.get('severity', 'unknown').upper()
-                    f.write(f"[{severity}] {issue.get('description', '')}\n")
-                f.write("\n")
-            
-            suggestions = analysis.get('suggestions', [])
-            if suggestions:
-                f.write("-" * 70 + "\n")
-                f.write(f"SUGGESTIONS ({len(suggestions)})\n")
-                f.write("-" * 70 + "\n")
-                for i, sug in enumerate(suggestions, 1):
-                    safe = "SAFE TO AUTO-APPLY" if sug.get('safe_to_auto_apply') else "MANUAL REVIEW REQUIRED"
-                    f.write(f"\n{i}. {sug.get('parameter', 'unknown')}\n")
-                    f.write(f"   Current: {sug.get('current', '?')}\n")
-                    f.write(f"   Suggested: {sug.get('suggested', '?')}\n")
-                    f.write(f"   Reason: {sug.get('reason', '')}\n")
-                    f.write(f"   [{safe}]\n")
-                f.write("\n")
-            
-            klippy_concerns = analysis.get('klippy_concerns', '')
-            if klippy_concerns and klippy_concerns.lower() != 'none':
-                f.write("-" * 70 + "\n")
-                f.write("KLIPPER LOG CONCERNS\n")
-                f.write("-" * 70 + "\n")
-                f.write(f"{klippy_concerns}\n\n")
-            
-            notes = analysis.get('notes', '')
-            if notes:
-                f.write("-" * 70 + "\n")
-                f.write("NOTES\n")
-                f.write("-" * 70 + "\n")
-                f.write(f"{notes}\n\n")
-            
-            f.write("=" * 70 + "\n")
-            f.write("END OF REPORT\n")
-            f.write("=" * 70 + "\n")
+            f.write(''.join(parts))
         
         return text_file, json_file
     except Exception as e:
@@ -255,6 +788,20 @@ def save_analysis_results(analysis, summary_file, provider, model):
         return None, None
 
 
+@functools.lru_cache(maxsize=None)
+def env_api_key(provider_name):
+    """Return the first API key set in the provider's key_env variables ('' if none).
+    
+    The environment doesn't change while the script runs, so each provider's
+    variables are looked up once.
+    """
+    for env_var in PROVIDERS[provider_name].get('key_env', []):
+        key = os.environ.get(env_var, '')
+        if key:
+            return key
+    return ''
+
+
 def configure_provider(provider_name):
     """Configure API settings for a specific provider."""
     if provider_name not in PROVIDERS:
@@ -265,6 +812,9 @@ def configure_provider(provider_name):
     provider = PROVIDERS[provider_name]
     CONFIG['api_url'] = provider['api_url']
     CONFIG['format'] = provider['format']
+    CONFIG['max_concurrency'] = provider['max_concurrency']
+    CONFIG['rpm'] = provider['rpm']
+    CONFIG['max_output_tokens'] = provider['max_output_tokens']
     
     # Use model from config file if set, otherwise provider default
     if not CONFIG.get('model'):
@@ -274,11 +824,7 @@ def configure_provider(provider_name):
     # Config file key is already in CONFIG['api_key'] from load_config_file()
     if not CONFIG.get('api_key'):
         # Fall back to environment variables
-        for env_var in provider.get('key_env', []):
-            key = os.environ.get(env_var, '')
-            if key:
-                CONFIG['api_key'] = key
-                break
+        CONFIG['api_key'] = env_api_key(provider_name)
     
     if not CONFIG.get('api_key'):
         print(f"Error: No API key found for {provider_name}")
@@ -290,7 +836,10 @@ def configure_provider(provider_name):
 # =============================================================================
 # ANALYSIS PROMPT - The secret sauce
 # =============================================================================
-ANALYSIS_PROMPT = """You are an expert 3D printing engineer analyzing thermal control data from a Klipper printer running Adaptive Flow.
+# Bump when editing the prompt so cached responses from the old prompt are not reused
+PROMPT_VERSION = '6'
+
+ANALYSIS_INTRO = """You are an expert 3D printing engineer analyzing thermal control data from a Klipper printer running Adaptive Flow.
 
 ## System Overview
 Adaptive Flow dynamically adjusts:
@@ -299,12 +848,15 @@ Adaptive Flow dynamically adjusts:
 - **DynZ**: Detects convex surface stress and reduces acceleration
 - **Smart Cooling**: Adjusts fan based on flow rate and layer time
 
-## Print Session Summary
+"""
+
+# Per-print data block - filled in by format_print_data()
+PRINT_DATA_TEMPLATE = """## Print Session Summary
 ```json
 {summary_json}
 ```
 
-## CSV Data Sample (time-series)
+## CSV Data Sample (time-series: first rows, peak pwm/boost rows, then the last rows)
 Columns: elapsed_s, temp_actual, temp_target, boost, flow, speed, pwm, pa, z_height, predicted_flow, dynz_active, accel, fan_pct
 ```csv
 {csv_sample}
@@ -315,7 +867,12 @@ Columns: elapsed_s, temp_actual, temp_target, boost, flow, speed, pwm, pa, z_hei
 {klippy_issues}
 ```
 
-## Analysis Guidelines
+"""
+
+# PRINT_DATA_TEMPLATE split once at its placeholders: [text, name, text, name, ..., text]
+PRINT_DATA_PARTS = re.split(r'\{(summary_json|csv_sample|klippy_issues)\}', PRINT_DATA_TEMPLATE)
+
+ANALYSIS_GUIDELINES = """## Analysis Guidelines
 
 IMPORTANT: Only report issues that are actually present in the data. A successful print should have NO issues.
 
@@ -379,11 +936,37 @@ Smart Cooling: sc_enable, sc_flow_gate, sc_flow_k, sc_min_fan, sc_max_fan
 
 If the print data looks good, return an empty issues array and "excellent" or "good" prediction."""
 
+# The instructions go in the system message and only print data in the user
+# message, so every request starts with the same bytes and the provider can
+# cache that prefix (cheaper, faster input processing)
+SYSTEM_PROMPT = ANALYSIS_INTRO + ANALYSIS_GUIDELINES
+SYSTEM_PROMPT_CACHE_KEY = hashlib.sha256(SYSTEM_PROMPT.encode('utf-8')).hexdigest()[:32]
+
+# Appended when several prints are packed into one request (--pack)
+MULTI_PRINT_INSTRUCTIONS = """
+
+## Multiple Prints
+The data above covers {count} separate prints, numbered from 0. Analyze each print
+independently using the output format from your instructions, and return ONLY a JSON array with one
+entry per print: [{{"id": 0, "analysis": {{...}}}}, {{"id": 1, "analysis": {{...}}}}]"""
+
+
+@functools.lru_cache(maxsize=16)
+def _read_summary(summary_path, mtime, size):
+    """Return (parsed, raw bytes) for a summary file; mtime and size key the cache."""
+    with open(summary_path, 'rb') as f:
+        raw = f.read()
+    return json_loads(raw), raw
+
 
 def load_summary(summary_path):
-    """Load summary JSON file and validate it contains print data."""
-    with open(summary_path, 'r') as f:
-        data = json.load(f)
+    """Load summary JSON file and validate it contains print data.
+    
+    Returns (summary, raw) - the raw file bytes are kept for the response
+    cache key so the file isn't read a second time.
+    """
+    st = os.stat(summary_path)
+    data, raw = _read_summary(summary_path, st.st_mtime, st.st_size)
     
     # Check if this is an analysis result file (corrupted/overwritten) instead of print data
     if 'analyzed_at' in data or 'analysis' in data:
@@ -405,32 +988,188 @@ def load_summary(summary_path):
             'avg_pwm': 0,
             'max_pwm': 0,
             '_error': 'This file contains analysis results, not print data. Run a new print to generate fresh data.'
-        }
+        }, raw
+    
+    return data, raw
+
+
+def read_csv_rows(csv_path, head_rows, tail_rows):
+    """Return (header, head, tail): the CSV header, its first head_rows rows and its last tail_rows rows.
+    
+    Only the start and a window at the end of the file are read, so the cost
+    stays constant however long the print log grows. The window starts at
+    CSV_TAIL_WINDOW bytes and doubles until it holds tail_rows rows. head
+    and tail never share a row.
+    """
+    with open(csv_path, 'rb') as f:
+        header_line = f.readline()
+        head = []
+        for _ in range(head_rows):
+            line = f.readline().rstrip(b'\r\n')
+            if not line:
+                break
+            head.append(line)
+        head_end = f.tell()
+        size = os.fstat(f.fileno()).st_size
+        window = CSV_TAIL_WINDOW
+        while True:
+            start = max(head_end, size - window)
+            if start > head_end:
+                # Start one byte early so a window landing on a line boundary keeps that line
+                f.seek(start - 1)
+                tail = f.read()
+                tail = tail[tail.find(b'\n') + 1:]  # Skip partial line
+            else:
+                f.seek(head_end)
+                tail = f.read()
+            lines = tail.splitlines()
+            if len(lines) >= tail_rows or start == head_end:
+                break
+            window *= 2
+    
+    # The monitor writes plain numeric rows (no quoting), so a split is enough.
+    # Only the kept rows are decoded, in one call
+    header = header_line.decode('utf-8', errors='ignore').strip().split(',')
+    if header == ['']:
+        header = []
+    lines = lines[-tail_rows:] if tail_rows > 0 else []
+    text = b'\n'.join(head + lines).decode('utf-8', errors='ignore')
+    rows = [line.split(',') for line in text.split('\n')] if head or lines else []
+    return header, rows[:len(head)], rows[len(head):]
+
+
+def _csv_value(row, index):
+    """Numeric value of row[index], or -inf if it is missing or not a number."""
+    try:
+        return float(row[index])
+    except (IndexError, ValueError):
+        return float('-inf')
+
+
+def scan_csv_rows(csv_path, head_rows, tail_rows, peak_rows):
+    """Return (header, rows): the first head_rows rows, the peak rows and the last tail_rows rows, in order.
+    
+    The peaks are the peak_rows highest values of each CSV_PEAK_COLUMNS
+    column over the whole file, read once, so heater saturation and large
+    boosts anywhere in the print reach the prompt. Only values above the
+    column's lowest value count, so a flat column adds no rows.
+    """
+    with open(csv_path, 'rb') as f:
+        header = f.readline().decode('utf-8', errors='ignore').strip().split(',')
+        if header == ['']:
+            return [], []
+        columns = [header.index(name) for name in CSV_PEAK_COLUMNS if name in header]
+        peaks = [[] for _ in columns]  # Min-heaps of (value, -row number, line)
+        lows = [float('inf')] * len(columns)
+        head = {}
+        tail = collections.deque(maxlen=tail_rows)
+        for n, line in enumerate(f):
+            line = line.rstrip(b'\r\n')
+            if not line:
+                continue
+            if n < head_rows:
+                head[n] = line
+            elif tail_rows > 0:
+                tail.append((n, line))
+            fields = line.split(b',')
+            for c, i in enumerate(columns):
+                value = _csv_value(fields, i)
+                lows[c] = min(lows[c], value)
+                if len(peaks[c]) < peak_rows:
+                    heapq.heappush(peaks[c], (value, -n, line))
+                elif value > peaks[c][0][0]:  # Ties keep the earlier row
+                    heapq.heapreplace(peaks[c], (value, -n, line))
     
-    return data
+    picked = head
+    picked.update(tail)
+    for heap, low in zip(peaks, lows):
+        picked.update((-n, line) for value, n, line in heap if value > low)
+    text = b'\n'.join(picked[n] for n in sorted(picked)).decode('utf-8', errors='ignore')
+    rows = [line.split(',') for line in text.split('\n')] if picked else []
+    return header, rows
 
 
 def load_csv_sample(csv_path, max_rows=100):
-    """Load last N rows of CSV for detailed analysis."""
-    if not os.path.exists(csv_path):
+    """Load a sample of CSV rows for detailed analysis (see scan_csv_rows)."""
+    try:
+        st = os.stat(csv_path)
+    except OSError:
         return "CSV file not found"
-    
+    return _load_csv_sample(csv_path, st.st_mtime, st.st_size, max_rows)
+
+
+@functools.lru_cache(maxsize=16)
+def _load_csv_sample(csv_path, mtime, size, max_rows):
+    """Build the CSV sample; mtime and size key the cache so a growing log is re-read."""
     try:
-        with open(csv_path, 'r') as f:
-            reader = csv.reader(f)
-            rows = list(reader)
-        
-        # Get header + last max_rows
-        if len(rows) <= max_rows + 1:
-            sample_rows = rows
+        # max_rows covers the first rows, the peak rows and the last rows
+        head_rows = min(CSV_HEAD_ROWS, max_rows // 5)
+        peak_rows = min(CSV_PEAK_ROWS, max_rows // 10)
+        tail_rows = max(0, max_rows - head_rows - peak_rows * len(CSV_PEAK_COLUMNS))
+        if peak_rows:
+            header, rows = scan_csv_rows(csv_path, head_rows, tail_rows, peak_rows)
         else:
-            sample_rows = [rows[0]] + rows[-(max_rows):]
+            header, head, tail = read_csv_rows(csv_path, head_rows, tail_rows)
+            rows = head + tail
+        if not header:
+            return ''
         
-        return '\n'.join([','.join(row) for row in sample_rows])
+        # Only send the columns the prompt describes (saves prompt tokens)
+        keep = [i for i, name in enumerate(header) if name in CSV_COLUMNS]
+        buf = io.StringIO()
+        writer = csv.writer(buf, lineterminator='\n')
+        writer.writerow([header[i] for i in keep])
+        writer.writerows([row[i] for i in keep if i < len(row)] for row in rows)
+        return buf.getvalue()[:-1]  # No newline after the last row
     except Exception as e:
         return f"Error reading CSV: {e}"
 
 
+def _klippy_stats_time(line):
+    """Return the time of a klippy.log "Stats 1703350000.123: ..." line, or None."""
+    idx = line.find('Stats ')
+    if idx < 0:
+        return None
+    fields = line[idx + 6:idx + 32].split(None, 1)
+    if not fields:
+        return None
+    # Validate "<digits>.<digits>" up front rather than catching float() errors per line
+    stamp = fields[0].rstrip(':')
+    whole, dot, frac = stamp.partition('.')
+    if not (dot and whole.isdecimal() and frac.isdecimal()):
+        return None
+    return float(stamp)
+
+
+def _seek_klippy_log(f, lo, hi, start_ts):
+    """Position f at a line start in [lo, hi) shortly before the first Stats line >= start_ts.
+    
+    Binary-searches on the Stats timestamps (klippy.log is chronological)
+    until the remaining span is KLIPPY_SEEK_SPAN bytes.
+    """
+    while hi - lo > KLIPPY_SEEK_SPAN:
+        mid = (lo + hi) // 2
+        f.seek(mid)
+        f.readline()  # Skip partial line
+        log_time = None
+        scanned = 0
+        while log_time is None and scanned < hi - mid:
+            line = f.readline()
+            if not line:
+                break
+            scanned += len(line)
+            if b'Stats ' in line:
+                log_time = _klippy_stats_time(line.decode('utf-8', 'ignore'))
+        if log_time is not None and log_time < start_ts:
+            lo = mid
+        else:
+            hi = mid  # Print starts earlier (or no timestamp found) - search the first half
+    
+    f.seek(lo)
+    if lo > 0:
+        f.readline()  # Skip partial line
+
+
 def extract_klippy_issues(start_time_str, duration_min):
     """Extract relevant warnings/errors from klippy.log during the print.
     
@@ -441,12 +1180,7 @@ def extract_klippy_issues(start_time_str, duration_min):
     - Print issues (pause, resume, error)
     - Any !! error lines
     """
-    import re
-    from datetime import datetime, timedelta
-    
-    klippy_log = os.path.expanduser('~/printer_data/logs/klippy.log')
-    if not os.path.exists(klippy_log):
-        return "klippy.log not found"
+    klippy_log = KLIPPY_LOG
     
     # Parse start time
     try:
@@ -457,67 +1191,64 @@ def extract_klippy_issues(start_time_str, duration_min):
     except:
         return "Could not parse print start time"
     
-    end_dt = start_dt + timedelta(minutes=duration_min + 5)  # Add 5 min buffer
-    
-    # Keywords to look for (case insensitive)
-    issue_patterns = [
-        r'!!',  # Error prefix
-        r'thermal',
-        r'heater',
-        r'temp.*error',
-        r'temp.*warning',
-        r'timer too close',
-        r'mcu.*error',
-        r'mcu.*timeout',
-        r'stepper',
-        r'tmc.*error',
-        r'driver',
-        r'pause',
-        r'shutdown',
-        r'lost communication',
-        r'overdue',
-    ]
-    pattern = re.compile('|'.join(issue_patterns), re.IGNORECASE)
+    # Compare raw log timestamps against the print window - no datetime per line
+    start_ts = start_dt.timestamp()
+    end_ts = start_ts + (duration_min + 5) * 60  # Add 5 min buffer
     
     # Klipper log timestamp format: "Stats 1703350000.123"
     # We need to match this to print time
+    # Only the first MAX_KLIPPY_ISSUES are kept; later distinct matches are
+    # just counted, so the prompt stays bounded however noisy the log is
     issues = []
+    seen = set()
+    extra = 0
+    
+    def add_issue(line):
+        nonlocal extra
+        clean_line = line.strip()[:200]  # Limit length
+        if clean_line not in seen:  # Dedupe
+            seen.add(clean_line)
+            if len(issues) < MAX_KLIPPY_ISSUES:
+                issues.append(clean_line)
+            else:
+                extra += 1
     
     try:
         # Only read last 2MB of log to stay reasonable
         max_bytes = 2 * 1024 * 1024
-        file_size = os.path.getsize(klippy_log)
         
-        with open(klippy_log, 'r', errors='ignore') as f:
-            if file_size > max_bytes:
-                f.seek(file_size - max_bytes)
-                f.readline()  # Skip partial line
-            
-            for line in f:
-                # Check if line matches any issue pattern
-                if pattern.search(line):
-                    # Try to extract timestamp
-                    ts_match = re.search(r'Stats (\d+\.\d+)', line)
-                    if ts_match:
-                        try:
-                            log_dt = datetime.fromtimestamp(float(ts_match.group(1)))
-                            # Check if within print window
-                            if start_dt <= log_dt <= end_dt:
-                                # Clean up the line
-                                clean_line = line.strip()[:200]  # Limit length
-                                if clean_line not in issues:  # Dedupe
-                                    issues.append(clean_line)
-                        except:
-                            pass
-                    elif '!!' in line:
-                        # Always include error lines
-                        clean_line = line.strip()[:200]
-                        if clean_line not in issues:
-                            issues.append(clean_line)
-        
-        # Limit to most relevant issues
-        if len(issues) > 30:
-            issues = issues[:30] + [f"... and {len(issues) - 30} more issues"]
+        try:
+            f = open(klippy_log, 'rb')
+        except FileNotFoundError:
+            return "klippy.log not found"
+        with f:
+            file_size = os.fstat(f.fileno()).st_size
+            # The log is chronological: skip ahead to just before the print
+            # started, and stop reading once past its end
+            _seek_klippy_log(f, max(0, file_size - max_bytes), file_size, start_ts)
+            # One read, decode and split instead of per-line text-mode iteration
+            lines = f.read().decode('utf-8', 'ignore').split('\n')
+        
+        for line in lines:
+            log_time = _klippy_stats_time(line)
+            if log_time is not None and log_time > end_ts:
+                break
+            # Cheap substring test first - most lines match no token and skip the regex
+            low = line.lower()
+            if not any(token in low for token in KLIPPY_FAST_TOKENS):
+                continue
+            # Check if line matches any issue pattern
+            if any(sub in low for sub in KLIPPY_ISSUE_SUBSTRINGS) or _KLIPPY_ISSUE_RE.search(low):
+                if log_time is not None:
+                    # Check if within print window
+                    if start_ts <= log_time <= end_ts:
+                        add_issue(line)
+                elif '!!' in line:
+                    # Always include error lines
+                    add_issue(line)
+        
+        if extra:
+            issues.append(f"... and {extra} more issues")
         
         if not issues:
             return "No issues found in klippy.log during print"
@@ -530,37 +1261,68 @@ def extract_klippy_issues(start_time_str, duration_min):
 
 def find_latest_summary():
     """Find the most recent summary JSON file."""
-    pattern = os.path.join(CONFIG['log_dir'], '*_summary.json')
-    files = glob.glob(pattern)
-    
-    if not files:
+    # One directory pass; scandir entries carry their stat info, so picking
+    # the newest file needs no separate getmtime call per file
+    try:
+        with os.scandir(CONFIG['log_dir']) as entries:
+            latest = max((e for e in entries
+                          if e.name.endswith('_summary.json') and not e.name.startswith('.')
+                          and e.is_file()),
+                         key=lambda e: e.stat().st_mtime, default=None)
+    except OSError:
         return None
     
-    # Sort by modification time, newest first
-    files.sort(key=os.path.getmtime, reverse=True)
-    return files[0]
+    return latest.path if latest else None
 
 
-def call_llm_api(prompt, summary_json, csv_sample, klippy_issues=""):
-    """Call the LLM API with the analysis prompt."""
-    import urllib.request
-    import ssl
-    
-    if not CONFIG['api_key']:
-        print("ERROR: No API key configured.")
-        print("Edit analysis_config.cfg or use --provider flag.")
-        print("\nAvailable providers:")
-        for name, info in PROVIDERS.items():
-            key_vars = ', '.join(info.get('key_env', ['none']))
-            print(f"  --provider {name:12} (keys: {key_vars})")
-        print("\nRecommended: --provider github (free with any GitHub account)")
-        return None
-    
-    # Build the full prompt
-    full_prompt = ANALYSIS_PROMPT.replace('{summary_json}', json.dumps(summary_json, indent=2))
-    full_prompt = full_prompt.replace('{csv_sample}', csv_sample)
-    full_prompt = full_prompt.replace('{klippy_issues}', klippy_issues or "No issues extracted")
+def compact_summary(summary):
+    """Reduce a summary to the LLM_FIELDS the analysis actually uses."""
+    if 'auto_temp' not in summary:
+        return summary  # Older summaries only have the flat fields
+    return {k: summary[k] for k in LLM_FIELDS if k in summary}
+
+
+def format_print_data(summary_json, csv_sample, klippy_issues=""):
+    """Fill the per-print data block of the prompt."""
+    values = {
+        # Compact separators and raw UTF-8 - indentation and \u escapes only cost prompt tokens
+        'summary_json': json.dumps(compact_summary(summary_json), separators=(',', ':'),
+                                   ensure_ascii=False),
+        'csv_sample': csv_sample,
+        'klippy_issues': klippy_issues or "No issues extracted",
+    }
+    # Odd entries of PRINT_DATA_PARTS are placeholder names
+    return ''.join(values[part] if i % 2 else part for i, part in enumerate(PRINT_DATA_PARTS))
+
+
+def build_prompt(summary_json, csv_sample, klippy_issues=""):
+    """Build the user message for a single print (instructions are in SYSTEM_PROMPT)."""
+    return format_print_data(summary_json, csv_sample, klippy_issues)
+
+
+def job_print_data(job):
+    """Return the job's data block (see format_print_data), formatted once and kept on the job."""
+    if 'print_data' not in job:
+        job['print_data'] = format_print_data(job['summary'], job['csv_sample'], job['klippy_issues'])
+    return job['print_data']
+
+
+def build_multi_prompt(jobs):
+    """Build one user message covering several prints, answered as a JSON array.
     
+    The instructions are sent once for the whole group instead of once per
+    print, which saves their input tokens and one round-trip per print.
+    """
+    parts = []
+    for i, job in enumerate(jobs):
+        parts.append(f"# Print {i}\n\n")
+        parts.append(job_print_data(job))
+    parts.append(MULTI_PRINT_INSTRUCTIONS.format(count=len(jobs)))
+    return ''.join(parts)
+
+
+def build_llm_request(user_prompt, max_tokens=LLM_MAX_TOKENS):
+    """Build the (headers, payload) for one request in the provider's format."""
     # Prepare API request
     headers = {
         'Content-Type': 'application/json',
@@ -570,79 +1332,271 @@ def call_llm_api(prompt, summary_json, csv_sample, klippy_issues=""):
     payload = {
         'model': CONFIG['model'],
         'messages': [
-            {'role': 'system', 'content': 'You are a 3D printing thermal control expert. Always respond with valid JSON.'},
-            {'role': 'user', 'content': full_prompt}
+            {'role': 'system', 'content': SYSTEM_PROMPT},
+            {'role': 'user', 'content': user_prompt}
         ],
-        'temperature': 0.3,  # Low temp for consistent, focused analysis
-        'max_tokens': 2000
+        'temperature': LLM_TEMPERATURE,
+        'max_tokens': max_tokens
     }
     
-    try:
-        # Handle Anthropic's different API format
-        if CONFIG['format'] == 'anthropic' or 'anthropic.com' in CONFIG['api_url']:
-            headers['x-api-key'] = CONFIG['api_key']
-            headers['anthropic-version'] = '2023-06-01'
-            if 'Authorization' in headers:
-                del headers['Authorization']
-            payload = {
-                'model': CONFIG['model'],
-                'max_tokens': 2000,
-                'messages': payload['messages']
-            }
-        
-        data = json.dumps(payload).encode('utf-8')
-        req = urllib.request.Request(CONFIG['api_url'], data=data, headers=headers)
-        
-        ctx = ssl.create_default_context()
-        with urllib.request.urlopen(req, timeout=60, context=ctx) as response:
-            result = json.loads(response.read().decode('utf-8'))
-        
-        # Extract content based on API format
-        if 'choices' in result:
-            # OpenAI format (GitHub, OpenAI)
-            content = result['choices'][0]['message']['content']
-        elif 'content' in result:
-            # Anthropic format
-            content = result['content'][0]['text']
+    # Route requests with the same instructions to the same prompt cache
+    if 'api.openai.com' in CONFIG['api_url']:
+        payload['prompt_cache_key'] = SYSTEM_PROMPT_CACHE_KEY
+    
+    # Handle Anthropic's different API format (system prompt is a top-level field)
+    if CONFIG['format'] == 'anthropic' or 'anthropic.com' in CONFIG['api_url']:
+        headers['x-api-key'] = CONFIG['api_key']
+        headers['anthropic-version'] = '2023-06-01'
+        if 'Authorization' in headers:
+            del headers['Authorization']
+        payload = {
+            'model': CONFIG['model'],
+            'max_tokens': max_tokens,
+            'temperature': LLM_TEMPERATURE,
+            'system': SYSTEM_PROMPT,
+            'messages': payload['messages'][1:]
+        }
+    
+    return headers, payload
+
+
+def extract_llm_content(result):
+    """Extract the response text from a provider's JSON reply."""
+    if 'choices' in result:
+        # OpenAI format (GitHub, OpenAI)
+        return result['choices'][0]['message']['content']
+    elif 'content' in result:
+        # Anthropic format
+        return result['content'][0]['text']
+    return str(result)
+
+
+def check_api_key():
+    """Return True if an API key is configured, otherwise explain how to set one."""
+    if CONFIG['api_key']:
+        return True
+    print("ERROR: No API key configured.")
+    print("Edit analysis_config.cfg or use --provider flag.")
+    print("\nAvailable providers:")
+    for name, info in PROVIDERS.items():
+        key_vars = ', '.join(info.get('key_env', ['none']))
+        print(f"  --provider {name:12} (keys: {key_vars})")
+    print("\nRecommended: --provider github (free with any GitHub account)")
+    return False
+
+
+def read_llm_stream(lines, on_text):
+    """Collect the text of a server-sent events response, passing each piece to on_text.
+    
+    Handles OpenAI-style chunks (choices[0].delta.content) and Anthropic
+    content_block_delta events; other events are skipped.
+    """
+    parts = []
+    for line in lines:
+        if not line.startswith(b'data:'):
+            continue  # "event:" names, comments and blank separators
+        data = line[5:].strip()
+        if not data or data == b'[DONE]':
+            continue
+        event = json_loads(data)
+        if event.get('type') == 'error':
+            raise RuntimeError(event.get('error', {}).get('message', 'stream error'))
+        if event.get('choices'):
+            text = event['choices'][0].get('delta', {}).get('content')
+        elif event.get('type') == 'content_block_delta':
+            text = event['delta'].get('text')
         else:
-            content = str(result)
+            text = None
+        if text:
+            on_text(text)
+            parts.append(text)
+    return ''.join(parts)
+
+
+def send_llm_request(user_prompt, max_tokens=LLM_MAX_TOKENS, on_text=None):
+    """Send a user message to the configured provider and return the response text.
+    
+    With on_text, the response is streamed and each piece of text is passed
+    to on_text as it arrives.
+    """
+    if not check_api_key():
+        return None
+    
+    headers, payload = build_llm_request(user_prompt, max_tokens)
+    if on_text:
+        payload['stream'] = True
+    
+    try:
+        data = json_dumps_compact(payload)
+        rpm = CONFIG.get('rpm')
+        if on_text:
+            return read_llm_stream(request_with_retry('POST', CONFIG['api_url'], data, headers,
+                                                      stream=True, rpm=rpm), on_text)
+        result = json_loads(request_with_retry('POST', CONFIG['api_url'], data, headers, rpm=rpm))
         
-        return content
+        return extract_llm_content(result)
         
     except Exception as e:
         print(f"API Error: {e}")
         return None
 
 
-def parse_llm_response(response_text):
-    """Extract JSON from LLM response."""
-    # Try to find JSON block in response
+def call_llm_api(summary_json, csv_sample, klippy_issues="", on_text=None):
+    """Call the LLM API with the analysis prompt (prepare_job() already skipped prints with no samples)."""
+    return send_llm_request(build_prompt(summary_json, csv_sample, klippy_issues), on_text=on_text)
+
+
+def call_llm_packed(jobs):
+    """Analyze several prints with one request (see build_multi_prompt).
+    
+    Returns the response text for each job, re-serialized per print so it
+    can be parsed and cached exactly like a single-print response.
+    """
+    max_tokens = min(LLM_MAX_TOKENS * len(jobs), CONFIG['max_output_tokens'])
+    response = send_llm_request(build_multi_prompt(jobs), max_tokens)
+    if not response:
+        return [None] * len(jobs)
+    
+    results = parse_llm_response(response)
+    if not isinstance(results, list):
+        print("Warning: Expected a JSON array for packed prints")
+        return [None] * len(jobs)
+    
+    responses = [None] * len(jobs)
+    for item in results:
+        if isinstance(item, dict) and isinstance(item.get('id'), int) and 0 <= item['id'] < len(jobs):
+            responses[item['id']] = json.dumps(item.get('analysis', {}))
+    missing = responses.count(None)
+    if missing:
+        print(f"Warning: LLM returned no analysis for {missing} of {len(jobs)} packed print(s)")
+    return responses
+
+
+def pack_jobs(jobs, pack_size):
+    """Group jobs for call_llm_packed, keeping each prompt within MAX_PACKED_PROMPT_CHARS."""
+    groups = []
+    group = []
+    group_chars = 0
+    for job in jobs:
+        job_chars = len(job_print_data(job))
+        if group and (len(group) >= pack_size or group_chars + job_chars > MAX_PACKED_PROMPT_CHARS):
+            groups.append(group)
+            group = []
+            group_chars = 0
+        group.append(job)
+        group_chars += job_chars
+    if group:
+        groups.append(group)
+    return groups
+
+
+def _batch_api_request(url, data=None, headers=None, method='POST'):
+    """Send one request to the provider's file/batch endpoints and return the body bytes."""
+    all_headers = {'Authorization': f'Bearer {CONFIG["api_key"]}'}
+    all_headers.update(headers or {})
+    if method == 'GET':
+        return request_with_retry(method, url, data, all_headers)
+    # Never resend uploads or batch creation - a retried POST could create a second batch
+    return _connections.request(method, url, data, all_headers, retry=False)
+
+
+def submit_batch(jobs, batch_url):
+    """Analyze several prints through the provider's Batch API.
+    
+    Batch jobs cost half as much as interactive requests and have separate
+    rate limits, but may take minutes to hours to complete. Uploads all
+    requests as one JSONL file, waits for the batch to finish, and returns
+    the response text for each job (None for failed requests).
+    """
+    files_url = batch_url.rsplit('/', 1)[0] + '/files'
+    
+    lines = []
+    for i, job in enumerate(jobs):
+        _, payload = build_llm_request(build_prompt(job['summary'], job['csv_sample'], job['klippy_issues']))
+        lines.append(json.dumps({
+            'custom_id': str(i),
+            'method': 'POST',
+            'url': '/v1/chat/completions',
+            'body': payload,
+        }, separators=(',', ':')))
+    
+    # Upload the requests file (multipart/form-data)
+    boundary = f"adaptiveflow{int(time.time() * 1000)}"
+    body = (
+        f'--{boundary}\r\nContent-Disposition: form-data; name="purpose"\r\n\r\nbatch\r\n'
+        f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="analysis.jsonl"\r\n'
+        f'Content-Type: application/jsonl\r\n\r\n'
+    ).encode('utf-8') + '\n'.join(lines).encode('utf-8') + f'\r\n--{boundary}--\r\n'.encode('utf-8')
+    
     try:
-        # Look for ```json ... ``` block
-        if '```json' in response_text:
-            start = response_text.index('```json') + 7
-            end = response_text.index('```', start)
-            json_str = response_text[start:end].strip()
-        elif '```' in response_text:
-            start = response_text.index('```') + 3
-            end = response_text.index('```', start)
-            json_str = response_text[start:end].strip()
-        else:
-            # Try to parse the whole thing
-            json_str = response_text.strip()
+        upload = json_loads(_batch_api_request(
+            files_url, body, {'Content-Type': f'multipart/form-data; boundary={boundary}'}))
+        batch = json_loads(_batch_api_request(batch_url, json.dumps({
+            'input_file_id': upload['id'],
+            'endpoint': '/v1/chat/completions',
+            'completion_window': '24h',
+        }).encode('utf-8'), {'Content-Type': 'application/json'}))
+        print(f"Submitted batch {batch['id']} ({len(jobs)} prints) - waiting for results...")
+        
+        # Poll until the batch reaches a final state
+        last_status = None
+        while batch['status'] not in ('completed', 'failed', 'expired', 'cancelled'):
+            if batch['status'] != last_status:
+                print(f"  Batch status: {batch['status']}")
+                last_status = batch['status']
+            time.sleep(BATCH_POLL_INTERVAL_S)
+            batch = json_loads(_batch_api_request(f"{batch_url}/{batch['id']}", method='GET'))
         
-        return json.loads(json_str)
+        if batch['status'] != 'completed' or not batch.get('output_file_id'):
+            print(f"API Error: batch {batch['id']} ended with status '{batch['status']}'")
+            return [None] * len(jobs)
+        
+        output = _batch_api_request(f"{files_url}/{batch['output_file_id']}/content", method='GET')
     except Exception as e:
-        print(f"Warning: Could not parse JSON response: {e}")
-        print("Raw response:")
-        print(response_text)
-        return None
+        print(f"API Error: {e}")
+        return [None] * len(jobs)
+    
+    # Split results back to their jobs (output order is not guaranteed)
+    responses = [None] * len(jobs)
+    for line in output.splitlines():
+        if not line.strip():
+            continue
+        item = json_loads(line)
+        response = item.get('response') or {}
+        if response.get('status_code') == 200:
+            responses[int(item['custom_id'])] = extract_llm_content(response['body'])
+        else:
+            print(f"API Error: batch request {item.get('custom_id')} failed: {item.get('error')}")
+    return responses
 
 
-def apply_suggestion(suggestion, moonraker_url):
-    """Apply a suggestion via Moonraker API."""
-    import urllib.request
+# First fenced block in an LLM response: ```json ... ``` or ``` ... ```
+_FENCE_RE = re.compile(r'```(?:json)?\s*(.*?)\s*```', re.DOTALL)
+
+
+def parse_llm_response(response_text, warn=True):
+    """Extract JSON from LLM response (with warn=False, fail without printing it)."""
+    # Use the fenced block if there is one, otherwise try to parse the whole thing
+    match = _FENCE_RE.search(response_text)
+    json_str = match.group(1) if match else response_text.strip()
     
+    try:
+        return json_loads(json_str)
+    except json.JSONDecodeError as e:  # orjson's error subclasses this too
+        if json5:
+            try:
+                return json5.loads(json_str)
+            except ValueError:
+                pass
+        if warn:
+            print(f"Warning: Could not parse JSON response: {e}")
+            print("Raw response:")
+            print(response_text)
+        return None
+
+
+def build_gcode(suggestion):
+    """Return the Klipper command that applies a suggestion, or None if unknown."""
     param = suggestion['parameter']
     value = suggestion['suggested']
     
@@ -655,117 +1609,91 @@ def apply_suggestion(suggestion, moonraker_url):
         'max_boost_limit': f'SET_GCODE_VARIABLE MACRO=_AUTO_TEMP_CORE VARIABLE=max_boost_limit VALUE={value}',
         'flow_smoothing': f'SET_GCODE_VARIABLE MACRO=_AUTO_TEMP_CORE VARIABLE=flow_smoothing VALUE={value}',
     }
-    
-    if param not in param_commands:
-        print(f"  Unknown parameter: {param}")
-        return False
-    
-    gcode = param_commands[param]
-    
-    try:
-        url = f"{moonraker_url}/printer/gcode/script?script={urllib.parse.quote(gcode)}"
-        req = urllib.request.Request(url, method='POST')
-        with urllib.request.urlopen(req, timeout=10) as response:
-            if response.status == 200:
-                print(f"  ✓ Applied: {gcode}")
-                return True
-    except Exception as e:
-        print(f"  ✗ Failed to apply {param}: {e}")
-    
-    return False
+    return param_commands.get(param)
 
 
-def main():
-    import argparse
+def run_gcode_script(script, moonraker_url):
+    """Run a (possibly multi-line) G-code script via Moonraker.
     
-    # Load config file first (sets defaults)
-    config_file = load_config_file()
-    config_provider = get_config_provider()
-    
-    parser = argparse.ArgumentParser(
-        description='Analyze Adaptive Flow print sessions using LLM',
-        formatter_class=argparse.RawDescriptionHelpFormatter,
-        epilog="""
-Providers:
-  github      GitHub Models (FREE!) - set GITHUB_TOKEN
-  openai      ChatGPT / GPT-4o-mini - set OPENAI_API_KEY
-  anthropic   Claude - set ANTHROPIC_API_KEY  
+    Returns True on success; HTTP errors raise urllib.error.HTTPError. Goes
+    through the shared connection pool, so repeated calls reuse one connection.
+    """
+    url = f"{moonraker_url}/printer/gcode/script?script={urllib.parse.quote(script)}"
+    _connections.request('POST', url, timeout=10)
+    return True
 
-Configuration:
-  Edit analysis_config.cfg to set provider and API key.
 
-Examples:
-  python3 analyze_print.py                     # Uses config file
-  python3 analyze_print.py --provider github   # Use GitHub Models
-  python3 analyze_print.py --auto              # Auto-apply safe suggestions
-        """
-    )
-    parser.add_argument('summary_file', nargs='?', help='Path to summary JSON (default: most recent)')
-    parser.add_argument('--auto', action='store_true', help='Auto-apply safe suggestions')
-    parser.add_argument('--raw', action='store_true', help='Show raw LLM response')
-    parser.add_argument('--verbose', '-v', action='store_true', help='Show full analysis in console (default: brief summary)')
-    parser.add_argument('--provider', '-p', choices=list(PROVIDERS.keys()),
-                        help='LLM provider to use (overrides config file)')
-    parser.add_argument('--model', '-m', help='Override model name')
-    parser.add_argument('--list-providers', action='store_true', help='Show available providers')
-    args = parser.parse_args()
+def apply_suggestion(suggestion, moonraker_url):
+    """Apply a suggestion via Moonraker API."""
+    return apply_suggestions([suggestion], moonraker_url) == 1
+
+
+def apply_suggestions(suggestions, moonraker_url):
+    """Apply suggestions with a single Moonraker script call. Returns how many were applied.
     
-    # List providers if requested
-    if args.list_providers:
-        print("Available LLM providers:\n")
-        for name, info in PROVIDERS.items():
-            key_vars = ', '.join(info.get('key_env', ['none needed']))
-            has_key = any(os.environ.get(k) for k in info.get('key_env', []))
-            status = "✓ configured" if has_key else "✗ no key"
-            print(f"  {name:12} model: {info['model']:30} [{status}]")
-            print(f"               keys: {key_vars}")
-        if config_file:
-            print(f"\nConfig file: {config_file}")
-            if config_provider:
-                print(f"Configured provider: {config_provider}")
-        return 0
+    If the combined script fails, each command is retried on its own so the
+    output shows which parameter was rejected (the commands only set
+    variables, so re-running ones that already succeeded is harmless).
+    """
+    commands = []
+    for suggestion in suggestions:
+        gcode = build_gcode(suggestion)
+        if gcode is None:
+            print(f"  Unknown parameter: {suggestion['parameter']}")
+        else:
+            commands.append((suggestion['parameter'], gcode))
     
-    # Configure provider: command line > config file > environment
-    provider = args.provider or config_provider
-    if provider:
-        if not configure_provider(provider):
-            return 1
-        print(f"Using provider: {provider} (model: {CONFIG['model']})")
-        if config_file and not args.provider:
-            print(f"  (from {os.path.basename(config_file)})")
+    if not commands:
+        return 0
     
-    # Override model if specified
-    if args.model:
-        CONFIG['model'] = args.model
+    try:
+        if run_gcode_script('\n'.join(gcode for _, gcode in commands), moonraker_url):
+            for _, gcode in commands:
+                print(f"  ✓ Applied: {gcode}")
+            return len(commands)
+    except Exception as e:
+        if len(commands) == 1:
+            print(f"  ✗ Failed to apply {commands[0][0]}: {e}")
+            return 0
+        print(f"  Combined script failed ({e}) - applying one at a time")
     
-    # Find summary file
-    if args.summary_file:
-        summary_path = args.summary_file
-    else:
-        summary_path = find_latest_summary()
-        if not summary_path:
-            print(f"No print logs found in {CONFIG['log_dir']}")
-            print("Run a print first to generate logs.")
-            return 1
+    applied = 0
+    for param, gcode in commands:
+        try:
+            if run_gcode_script(gcode, moonraker_url):
+                print(f"  ✓ Applied: {gcode}")
+                applied += 1
+        except Exception as e:
+            print(f"  ✗ Failed to apply {param}: {e}")
+    return applied
+
+
+def prepare_job(summary_path):
+    """Load one print's data and show quick stats.
     
+    Returns a job dict with the summary, CSV sample and klippy issues, or
+    None if the summary is unusable.
+    """
     print(f"Analyzing: {summary_path}")
     print("-" * 60)
     
     # Load data
-    summary = load_summary(summary_path)
+    summary, summary_bytes = load_summary(summary_path)
     
     # Check for corrupted/overwritten file
     if summary.get('_error'):
         print(f"\n❌ ERROR: {summary['_error']}")
         print("\nThis can happen if a previous version of the script overwrote the summary file.")
         print("To fix: Run a new print to generate fresh logging data.")
-        return 1
+        return None
     
     # Validate we have actual data
     if summary.get('samples', 0) == 0:
         print(f"\n⚠️  WARNING: Summary file contains 0 samples!")
         print("   This print may have been too short, or logging wasn't active.")
         print("   Make sure AT_START is called at print start and AT_END at print end.")
+        print("   Skipping LLM analysis - there is no print data to analyze.")
+        return None
     
     csv_path = summary_path.replace('_summary.json', '.csv')
     csv_sample = load_csv_sample(csv_path, CONFIG.get('max_csv_rows', 100))
@@ -798,28 +1726,43 @@ Examples:
         print(f"Klippy Issues: None")
     
     print("-" * 60)
-    print("Sending to LLM for analysis...")
     
-    # Call LLM
-    response = call_llm_api(ANALYSIS_PROMPT, summary, csv_sample, klippy_issues)
+    return {
+        'summary_path': summary_path,
+        'summary': summary,
+        'summary_bytes': summary_bytes,
+        'csv_sample': csv_sample,
+        'klippy_issues': klippy_issues,
+    }
+
+
+def report_job(job, args, provider_name, model_name):
+    """Parse, save and display the LLM response for one print. Returns True on success."""
+    response = job['response']
+    summary_path = job['summary_path']
     
     if not response:
-        return 1
+        return False
     
-    if args.raw:
-        print("\nRaw LLM Response:")
-        print(response)
-        return 0
+    # Parse response - quietly with --raw, which shows the response as is.
+    # Only a parseable response is cached, --raw or not
+    analysis = parse_llm_response(response, warn=not args.raw)
     
-    # Parse response
-    analysis = parse_llm_response(response)
+    if analysis and not args.no_cache and not job['cache_hit']:
+        save_cached_response(job['cache_key'], response)
+        if CONFIG['similar_cache']:
+            index_similar_response(job['cache_key'], job['summary'])
+    
+    if args.raw:
+        if not job['streamed']:  # --stream already printed it
+            print("\nRaw LLM Response:")
+            print(response)
+        return True
     
     if not analysis:
-        return 1
+        return False
     
     # Save analysis results
-    provider_name = args.provider or config_provider or 'custom'
-    model_name = CONFIG.get('model', 'unknown')
     text_file, json_file = save_analysis_results(analysis, summary_path, provider_name, model_name)
     
     # Count issues and suggestions for summary
@@ -919,14 +1862,201 @@ Examples:
         print("\n" + "-" * 60)
         print("AUTO-APPLYING SAFE SUGGESTIONS...")
         
-        for sug in suggestions:
-            if sug.get('safe_to_auto_apply'):
-                apply_suggestion(sug, CONFIG['moonraker_url'])
+        # One Moonraker call for all safe suggestions instead of one per suggestion
+        apply_suggestions([s for s in suggestions if s.get('safe_to_auto_apply')],
+                          CONFIG['moonraker_url'])
         
         print("\nNote: Changes are temporary until Klipper restart.")
         print("To make permanent, edit auto_flow.cfg")
     
-    return 0
+    return True
+
+
+def main():
+    # Load config file first (sets defaults)
+    config_file, config_provider = load_config_file()
+    
+    parser = argparse.ArgumentParser(
+        description='Analyze Adaptive Flow print sessions using LLM',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Providers:
+  github      GitHub Models (FREE!) - set GITHUB_TOKEN
+  openai      ChatGPT / GPT-4o-mini - set OPENAI_API_KEY
+  anthropic   Claude - set ANTHROPIC_API_KEY  
+
+Configuration:
+  Edit analysis_config.cfg to set provider and API key.
+
+Summaries with 0 samples (or overwritten by an analysis result) are skipped
+without calling the LLM, and the exit code is 1.
+
+Examples:
+  python3 analyze_print.py                     # Uses config file
+  python3 analyze_print.py --provider github   # Use GitHub Models
+  python3 analyze_print.py --auto              # Auto-apply safe suggestions
+  python3 analyze_print.py a.json b.json       # Analyze several prints at once
+  python3 analyze_print.py --batch '2024*'     # Analyze matching prints in log_dir
+        """
+    )
+    parser.add_argument('summary_files', nargs='*', metavar='summary_file',
+                        help='Path(s) to summary JSON (default: most recent)')
+    parser.add_argument('--batch', metavar='PATTERN',
+                        help='Analyze all summaries in log_dir matching PATTERN (e.g. "*")')
+    parser.add_argument('--auto', action='store_true', help='Auto-apply safe suggestions')
+    parser.add_argument('--raw', action='store_true', help='Show raw LLM response')
+    parser.add_argument('--stream', action='store_true',
+                        help='Print the LLM response as it is generated (when analyzing one print)')
+    parser.add_argument('--verbose', '-v', action='store_true', help='Show full analysis in console (default: brief summary)')
+    parser.add_argument('--provider', '-p', choices=list(PROVIDERS.keys()),
+                        help='LLM provider to use (overrides config file)')
+    parser.add_argument('--model', '-m', help='Override model name')
+    parser.add_argument('--list-providers', action='store_true', help='Show available providers')
+    parser.add_argument('--batch-api', action='store_true',
+                        help='Submit prints as one Batch API job (50%% cheaper, results may take hours)')
+    parser.add_argument('--pack', type=int, default=1, metavar='N',
+                        help='Analyze up to N prints per LLM request when analyzing several prints')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Always query the LLM, ignoring and not updating cached responses')
+    parser.add_argument('--refresh', action='store_true',
+                        help='Always query the LLM and replace the cached response')
+    args = parser.parse_args()
+    
+    # List providers if requested
+    if args.list_providers:
+        print("Available LLM providers:\n")
+        for name, info in PROVIDERS.items():
+            key_vars = ', '.join(info.get('key_env', ['none needed']))
+            has_key = bool(env_api_key(name))
+            status = "✓ configured" if has_key else "✗ no key"
+            print(f"  {name:12} model: {info['model']:30} [{status}]")
+            print(f"               keys: {key_vars}")
+        if config_file:
+            print(f"\nConfig file: {config_file}")
+            if config_provider:
+                print(f"Configured provider: {config_provider}")
+        return 0
+    
+    # Configure provider: command line > config file > environment
+    provider = args.provider or config_provider
+    if provider:
+        if not configure_provider(provider):
+            return 1
+        print(f"Using provider: {provider} (model: {CONFIG['model']})")
+        if config_file and not args.provider:
+            print(f"  (from {os.path.basename(config_file)})")
+    
+    # Override model if specified
+    if args.model:
+        CONFIG['model'] = args.model
+    
+    batch_url = PROVIDERS.get(provider, {}).get('batch_url')
+    if args.batch_api:
+        if not batch_url:
+            supported = ', '.join(name for name, info in PROVIDERS.items() if info.get('batch_url'))
+            print(f"Error: --batch-api is only supported by: {supported}")
+            return 1
+        if not check_api_key():
+            return 1
+    
+    # Find summary files
+    summary_paths = list(args.summary_files)
+    if args.batch:
+        pattern = args.batch
+        if not pattern.endswith('_summary.json'):
+            pattern += '_summary.json'
+        summary_paths += sorted(glob.glob(os.path.join(CONFIG['log_dir'], pattern)))
+        if not summary_paths:
+            print(f"No print logs matching '{args.batch}' in {CONFIG['log_dir']}")
+            return 1
+    if not summary_paths:
+        summary_path = find_latest_summary()
+        if not summary_path:
+            print(f"No print logs found in {CONFIG['log_dir']}")
+            print("Run a print first to generate logs.")
+            return 1
+        summary_paths = [summary_path]
+    
+    # Load data and show quick stats for every print
+    jobs = []
+    exit_code = 0
+    for summary_path in summary_paths:
+        job = prepare_job(summary_path)
+        if job is None:
+            exit_code = 1
+        else:
+            jobs.append(job)
+    
+    # Reuse a previous response for identical input (same print, prompt and model)
+    # or, with similar_cache enabled, for a print with near-identical statistics
+    pending = []
+    for job in jobs:
+        job['cache_key'] = _cache_key(job['summary_bytes'], job['csv_sample'], job['klippy_issues'],
+                                      CONFIG['model'], PROMPT_VERSION)
+        job['response'] = None
+        job['cache_hit'] = False
+        job['streamed'] = False
+        if not (args.no_cache or args.refresh):
+            job['response'] = load_cached_response(job['cache_key'])
+            if job['response']:
+                print(f"Using cached LLM analysis for {os.path.basename(job['summary_path'])} (--refresh to re-run)")
+            elif CONFIG['similar_cache']:
+                job['response'] = find_similar_response(job['summary'])
+                if job['response']:
+                    print(f"Reusing analysis of a similar print for {os.path.basename(job['summary_path'])} "
+                          f"(--refresh to re-run)")
+            job['cache_hit'] = bool(job['response'])
+        if not job['cache_hit']:
+            pending.append(job)
+    
+    # Identical inputs (the same print listed twice, or byte-identical reprints)
+    # share a single request - only the first job with each key is sent
+    duplicates = {}
+    for job in pending:
+        duplicates.setdefault(job['cache_key'], []).append(job)
+    pending = [same_jobs[0] for same_jobs in duplicates.values()]
+    
+    # Call LLM - requests for several prints run concurrently, so the batch
+    # takes about as long as the slowest request instead of the sum of all
+    if pending:
+        print(f"Sending {len(pending)} print(s) to LLM for analysis..." if len(pending) > 1
+              else "Sending to LLM for analysis...")
+        if args.batch_api:
+            responses = submit_batch(pending, batch_url)
+        elif args.pack > 1 and len(pending) > 1:
+            groups = pack_jobs(pending, args.pack)
+            with ThreadPoolExecutor(max_workers=min(len(groups), CONFIG['max_concurrency'])) as executor:
+                responses = [r for group_responses in executor.map(call_llm_packed, groups)
+                             for r in group_responses]
+        elif len(pending) == 1:
+            on_text = None
+            if args.stream:
+                def on_text(text):
+                    sys.stdout.write(text)
+                    sys.stdout.flush()
+            responses = [call_llm_api(pending[0]['summary'], pending[0]['csv_sample'],
+                                      pending[0]['klippy_issues'], on_text)]
+            if args.stream:
+                print()
+                pending[0]['streamed'] = True
+        else:
+            with ThreadPoolExecutor(max_workers=min(len(pending), CONFIG['max_concurrency'])) as executor:
+                responses = list(executor.map(
+                    lambda job: call_llm_api(job['summary'], job['csv_sample'], job['klippy_issues']),
+                    pending))
+        for first_job, response in zip(pending, responses):
+            for job in duplicates[first_job['cache_key']]:
+                job['response'] = response
+    
+    provider_name = args.provider or config_provider or 'custom'
+    model_name = CONFIG.get('model', 'unknown')
+    for job in jobs:
+        if len(jobs) > 1:
+            print(f"\n{os.path.basename(job['summary_path'])}:")
+        if not report_job(job, args, provider_name, model_name):
+            exit_code = 1
+    
+    return exit_code
 
 
 if __name__ == '__main__':
@@ -1,4 +1,5 @@
 import logging
+import re
 import threading
 import time
 import json
@@ -11,6 +12,45 @@ from datetime import datetime
 LOG_DIR = "~/printer_data/logs/adaptive_flow"
 MAX_LOG_FILES = 20  # Keep last 20 print logs
 
+_LOG = logging.getLogger('ExtruderMonitor')
+
+# Lookahead segments kept at most (several seconds of motion); the oldest are
+# dropped first so a long print with live G-code parsing stays bounded
+MAX_LOOKAHEAD_SEGMENTS = 512
+
+# Lookahead segments older than this no longer count toward the predicted rate
+LOOKAHEAD_MAX_AGE_S = 5.0
+
+# Tiny, quick extrusion moves (primes, wipes, gap fill) are sampled: only one
+# in LOOKAHEAD_TINY_SAMPLE is added to the lookahead, weighted to stand for all
+LOOKAHEAD_TINY_E = 0.01  # mm
+LOOKAHEAD_TINY_MAX_S = 0.2  # longer moves are always kept
+LOOKAHEAD_TINY_SAMPLE = 10
+
+# G-code word: axis/parameter letter followed by a number, e.g. "X12.5" or "E-0.8"
+_GCODE_PARAM_RE = re.compile(r'([A-Za-z])([-+]?[0-9]*\.?[0-9]+)')
+
+
+def _parse_gcode_params(line):
+    """Return {letter: value} for the X/Y/Z/E/F words of a G0/G1 move.
+
+    Slicers separate words with spaces, so a split plus float() per word is
+    enough; lines with words run together ("G1X10Y20") or odd numbers fall
+    back to the regex.
+    """
+    code = line.split(';', 1)[0]
+    words = code.upper().split()
+    if words and words[0][1:].isdigit():
+        params = {}
+        try:
+            for word in words[1:]:
+                if word[0] in 'XYZEF':
+                    params[word[0]] = float(word[1:])
+            return params
+        except ValueError:
+            pass
+    return {m.group(1).upper(): float(m.group(2)) for m in _GCODE_PARAM_RE.finditer(code)}
+
 
 class ExtruderMonitor:
     """Monitor extruder load and accept simple lookahead segments.
@@ -28,6 +68,10 @@ class ExtruderMonitor:
         # lookahead buffer and bookkeeping
         self._lookahead_lock = threading.Lock()
         self._lookahead = deque()  # entries are (e_delta_mm, duration_s, timestamp)
+        # running totals (sum of |e|, sum of duration) over _lookahead, so the
+        # predicted rate doesn't have to re-sum the buffer on every query.
+        # Always replaced as a whole tuple, so readers can take it without the lock
+        self._totals = (0.0, 0.0)
 
         # keep a tiny history of recent extrusion rates (mm/s) to allow basic
         # normalization when estimating future load
@@ -37,10 +81,7 @@ class ExtruderMonitor:
         self._gcode_last_e = None
         self._gcode_last_f = None
         self._relative_extrusion = False  # M83 sets True, M82 sets False
-        
-        # Pre-compile regex for performance
-        import re
-        self._param_re = re.compile(r'([A-Za-z])([-+]?[0-9]*\.?[0-9]+)')
+        self._tiny_moves = 0  # counter for sampling tiny moves
         
         # Print session logging
         self._log_lock = threading.Lock()
@@ -71,7 +112,7 @@ class ExtruderMonitor:
             interceptor = self.printer.lookup_object('gcode_interceptor')
             interceptor.register_gcode_callback(self._on_gcode_line)
             hook_installed = True
-            logging.getLogger('ExtruderMonitor').info(
+            _LOG.info(
                 'Live G-code lookahead hook installed via gcode_interceptor.')
         except Exception:
             pass
@@ -100,36 +141,73 @@ class ExtruderMonitor:
                 pass
 
             if hook_installed:
-                logging.getLogger('ExtruderMonitor').info(
+                _LOG.info(
                     'Live G-code lookahead hook installed via legacy event API.')
 
         if not hook_installed:
-            logging.getLogger('ExtruderMonitor').warning(
+            _LOG.warning(
                 'Live G-code lookahead hook not installed. '
                 'Add [gcode_interceptor] to printer.cfg for automatic lookahead.')
 
     def _on_gcode_line(self, line):
         """Simple callback for gcode_interceptor - receives raw G-code line."""
-        if not line:
+        # Dispatch on the first characters - most lines (M-codes, macros,
+        # comments) are neither a move nor M82/M83 and need no upper() copy
+        s = line.lstrip()
+        if len(s) < 2:
             return
-        up = line.upper().strip()
-        # Handle G0/G1 moves and M82/M83 extrusion mode commands
-        if up.startswith('G0') or up.startswith('G1') or up.startswith('M82') or up.startswith('M83'):
-            self._parse_gcode_move(line)
+        c0 = s[0]
+        if c0 in 'Gg':
+            if s[1] in '01':
+                self._parse_gcode_move(s)
+        elif c0 in 'Mm':
+            code = s[1:3]
+            if code == '83':
+                self._relative_extrusion = True
+            elif code == '82':
+                self._relative_extrusion = False
 
     # Public lookahead API (can be called from other modules)
     def add_lookahead_segment(self, e_delta_mm, duration_s):
         if duration_s <= 0:
             return
+        e = float(e_delta_mm)
+        d = float(duration_s)
+        now = time.monotonic()
         with self._lookahead_lock:
-            self._lookahead.append((float(e_delta_mm), float(duration_s), time.time()))
+            # Expire here too, so the lock-free read in _predicted_extrusion_rate
+            # usually finds nothing stale while a print is feeding segments
+            self._expire_lookahead(now)
+            if len(self._lookahead) >= MAX_LOOKAHEAD_SEGMENTS:
+                self._pop_lookahead()
+            self._lookahead.append((e, d, now))
+            sum_e, sum_t = self._totals
+            self._totals = (sum_e + abs(e), sum_t + max(1e-6, d))
 
     def clear_lookahead(self):
         with self._lookahead_lock:
             self._lookahead.clear()
+            self._totals = (0.0, 0.0)
+
+    def _pop_lookahead(self):
+        """Drop the oldest segment from the running totals. Caller holds _lookahead_lock."""
+        e, d, _ = self._lookahead.popleft()
+        if self._lookahead:
+            sum_e, sum_t = self._totals
+            self._totals = (sum_e - abs(e), sum_t - max(1e-6, d))
+        else:
+            # Start over from exact zeros so float error can't build up
+            self._totals = (0.0, 0.0)
+
+    def _expire_lookahead(self, now):
+        """Drop segments older than LOOKAHEAD_MAX_AGE_S. Caller holds _lookahead_lock."""
+        cutoff = now - LOOKAHEAD_MAX_AGE_S
+        lookahead = self._lookahead
+        while lookahead and lookahead[0][2] < cutoff:
+            self._pop_lookahead()
 
     def _on_gcode_event(self, *args, **kwargs):
-        """Try to extract raw G-code line from event and parse G0/G1 moves.
+        """Try to extract raw G-code line from event and hand it to _on_gcode_line.
 
         The event API varies; we defensively look through args/kwargs for
         something resembling the raw command string.
@@ -167,61 +245,21 @@ class ExtruderMonitor:
                     except Exception:
                         pass
 
-        if not raw:
-            return
-
-        line = raw.strip()
-        if not line:
-            return
-        up = line.upper()
-        if not (up.startswith('G0') or up.startswith('G1')):
-            return
-
-        self._parse_gcode_move(line)
+        if raw:
+            self._on_gcode_line(raw)
 
     def _parse_gcode_move(self, line):
         """Parse a G0/G1 move and add to lookahead if it contains extrusion."""
-        # Check for extrusion mode commands
-        up = line.upper().strip()
-        if up.startswith('M83'):
-            self._relative_extrusion = True
-            return
-        elif up.startswith('M82'):
-            self._relative_extrusion = False
-            return
-        
-        params = {}
-        for m in self._param_re.finditer(line):
-            params[m.group(1).upper()] = float(m.group(2))
+        params = _parse_gcode_params(line)
 
         cur_e = params.get('E', None)
         cur_f = params.get('F', None)
 
-        # compute Euclidean distance if coordinates available (works with X/Y only)
-        dist = 0.0
-        coords = {}
-        for axis in ('X', 'Y', 'Z'):
-            coords[axis] = params.get(axis, self._gcode_pos.get(axis))
-
-        # Calculate distance with available axes (don't require all 3)
-        try:
-            dx = 0.0
-            dy = 0.0
-            dz = 0.0
-            if coords['X'] is not None and self._gcode_pos['X'] is not None:
-                dx = coords['X'] - self._gcode_pos['X']
-            if coords['Y'] is not None and self._gcode_pos['Y'] is not None:
-                dy = coords['Y'] - self._gcode_pos['Y']
-            if coords['Z'] is not None and self._gcode_pos['Z'] is not None:
-                dz = coords['Z'] - self._gcode_pos['Z']
-            dist = (dx*dx + dy*dy + dz*dz) ** 0.5
-        except Exception:
-            dist = 0.0
-
-        # Track travel vs extrusion for diagnostics
-        has_extrusion = False
+        pos = self._gcode_pos
+        x, y, z = params.get('X'), params.get('Y'), params.get('Z')
 
-        # if extrusion present, compute delta
+        # Only moves with positive extrusion feed the lookahead - travels and
+        # retractions skip straight to updating the tracked position below
         if cur_e is not None:
             if self._relative_extrusion:
                 # In relative mode, E value IS the delta
@@ -231,59 +269,69 @@ class ExtruderMonitor:
             else:
                 delta_e = cur_e - self._gcode_last_e
 
-            # Only count positive extrusion (not retractions)
             if delta_e > 0:
-                has_extrusion = True
-
-            # estimate duration
-            duration = None
-            feed = cur_f if cur_f is not None else self._gcode_last_f
-            if feed and dist > 0.0:
-                try:
-                    duration = dist * 60.0 / float(feed)
-                except Exception:
-                    duration = None
-            if duration is None:
-                duration = max(0.001, abs(delta_e) / 1.0)
-
-            if delta_e > 0:
-                try:
-                    self.add_lookahead_segment(delta_e, duration)
-                    # record recent rate
-                    rate = abs(delta_e) / max(1e-6, float(duration))
+                # compute Euclidean distance if coordinates available (works with
+                # X/Y only) - an axis missing from the move didn't change
+                dx = x - pos['X'] if x is not None and pos['X'] is not None else 0.0
+                dy = y - pos['Y'] if y is not None and pos['Y'] is not None else 0.0
+                dz = z - pos['Z'] if z is not None and pos['Z'] is not None else 0.0
+                dist = (dx*dx + dy*dy + dz*dz) ** 0.5
+
+                # estimate duration
+                duration = None
+                feed = cur_f if cur_f is not None else self._gcode_last_f
+                if feed and dist > 0.0:
                     try:
-                        self._recent_rates.append(rate)
+                        duration = dist * 60.0 / float(feed)
+                    except Exception:
+                        duration = None
+                if duration is None:
+                    duration = max(0.001, abs(delta_e) / 1.0)
+
+                # Scaling both E and duration by the sample size keeps the
+                # sampled moves' share of the predicted rate unchanged
+                weight = 1
+                if delta_e < LOOKAHEAD_TINY_E and duration <= LOOKAHEAD_TINY_MAX_S:
+                    self._tiny_moves += 1
+                    weight = 0 if self._tiny_moves % LOOKAHEAD_TINY_SAMPLE else LOOKAHEAD_TINY_SAMPLE
+
+                if weight:
+                    try:
+                        self.add_lookahead_segment(delta_e * weight, duration * weight)
+                        # record recent rate
+                        rate = abs(delta_e) / max(1e-6, float(duration))
+                        try:
+                            self._recent_rates.append(rate)
+                        except Exception:
+                            pass
                     except Exception:
                         pass
-                except Exception:
-                    pass
 
         # update stored state
         if cur_e is not None:
             self._gcode_last_e = cur_e
         if cur_f is not None:
             self._gcode_last_f = cur_f
-        for axis in ('X','Y','Z'):
-            if axis in params:
-                self._gcode_pos[axis] = params[axis]
+        if x is not None:
+            pos['X'] = x
+        if y is not None:
+            pos['Y'] = y
+        if z is not None:
+            pos['Z'] = z
 
     def _predicted_extrusion_rate(self):
         """Return predicted extrusion rate in mm/s computed from current lookahead."""
-        # Expire stale entries older than 5 seconds
-        now = time.time()
-        max_age = 5.0
-        with self._lookahead_lock:
-            # Remove expired entries from the front of the deque
-            while self._lookahead and (now - self._lookahead[0][2]) > max_age:
-                self._lookahead.popleft()
-            
-            total_e = 0.0
-            total_t = 0.0
-            for e, d, ts in self._lookahead:
-                # Only consider entries within the time window
-                if (now - ts) <= max_age:
-                    total_e += abs(e)
-                    total_t += max(1e-6, float(d))
+        # Only take the lock when the oldest entry has gone stale; entries are
+        # appended in time order, so otherwise everything is within the window
+        now = time.monotonic()
+        try:
+            stale = self._lookahead[0][2] < now - LOOKAHEAD_MAX_AGE_S
+        except IndexError:
+            stale = False
+        if stale:
+            with self._lookahead_lock:
+                self._expire_lookahead(now)
+        total_e, total_t = self._totals
         if total_t <= 0:
             return 0.0
         return total_e / total_t
@@ -354,11 +402,9 @@ class ExtruderMonitor:
     def _cleanup_old_logs(self, log_dir):
         """Keep only the most recent MAX_LOG_FILES log files."""
         try:
-            files = []
-            for f in os.listdir(log_dir):
-                if f.endswith('.csv'):
-                    path = os.path.join(log_dir, f)
-                    files.append((os.path.getmtime(path), path))
+            # scandir entries carry their stat info - no extra getmtime per file
+            with os.scandir(log_dir) as entries:
+                files = [(e.stat().st_mtime, e.path) for e in entries if e.name.endswith('.csv')]
             
             files.sort(reverse=True)
             for _, path in files[MAX_LOG_FILES:]:
@@ -366,16 +412,14 @@ class ExtruderMonitor:
                     os.remove(path)
                     # Also remove corresponding JSON summary
                     json_path = path.replace('.csv', '_summary.json')
-                    if os.path.exists(json_path):
-                        os.remove(json_path)
+                    os.remove(json_path)
                 except:
                     pass
         except Exception as e:
-            logging.getLogger('ExtruderMonitor').debug(f"Log cleanup error: {e}")
+            _LOG.debug(f"Log cleanup error: {e}")
 
     def cmd_AT_LOG_START(self, gcmd):
         """Start a new logging session for this print."""
-        logger = logging.getLogger('ExtruderMonitor')
         
         material = gcmd.get('MATERIAL', 'UNKNOWN')
         filename = gcmd.get('FILE', 'unknown')
@@ -409,7 +453,7 @@ class ExtruderMonitor:
                 ])
                 self._log_file.flush()  # Ensure header is written to disk
                 
-                self._log_start_time = time.time()
+                self._log_start_time = time.monotonic()
                 self._log_sample_count = 0
                 
                 # Parse optional feature flags
@@ -465,11 +509,11 @@ class ExtruderMonitor:
                 }
                 
                 gcmd.respond_info(f"AT_LOG: Started logging to {log_path}")
-                logger.info(f"Started print logging: {log_path}")
+                _LOG.info(f"Started print logging: {log_path}")
                 
             except Exception as e:
                 gcmd.respond_info(f"AT_LOG: Failed to start logging: {e}")
-                logger.error(f"Failed to start logging: {e}")
+                _LOG.error(f"Failed to start logging: {e}")
 
     def cmd_AT_LOG_DATA(self, gcmd):
         """Log a single data point during printing."""
@@ -478,7 +522,7 @@ class ExtruderMonitor:
                 return  # Logging not active
             
             try:
-                elapsed = time.time() - self._log_start_time
+                elapsed = time.monotonic() - self._log_start_time
                 temp_actual = gcmd.get_float('TEMP', 0.0)
                 temp_target = gcmd.get_float('TARGET', 0.0)
                 boost = gcmd.get_float('BOOST', 0.0)
@@ -584,11 +628,10 @@ class ExtruderMonitor:
                     self._log_file.flush()
                     
             except Exception as e:
-                logging.getLogger('ExtruderMonitor').debug(f"Log data error: {e}")
+                _LOG.debug(f"Log data error: {e}")
 
     def cmd_AT_LOG_END(self, gcmd):
         """End logging session and write summary."""
-        logger = logging.getLogger('ExtruderMonitor')
         
         with self._log_lock:
             if not self._log_file:
@@ -597,7 +640,7 @@ class ExtruderMonitor:
             
             try:
                 # Calculate final stats
-                duration_s = time.time() - self._log_start_time
+                duration_s = time.monotonic() - self._log_start_time
                 samples = self._log_sample_count
                 
                 if samples > 0:
@@ -721,13 +764,13 @@ class ExtruderMonitor:
                     gcmd.respond_info(f"AT_LOG: Cooling: {sc['fan_min']}-{sc['fan_max']}% (avg {sc['fan_avg']:.0f}%), {sc['fan_adjustments']} adjustments")
                     
                     gcmd.respond_info(f"AT_LOG: Summary saved to {summary_path}")
-                    logger.info(f"Print log summary: {summary}")
+                    _LOG.info(f"Print log summary: {summary}")
                 
                 self._log_file.close()
                 
             except Exception as e:
                 gcmd.respond_info(f"AT_LOG: Error ending session: {e}")
-                logger.error(f"Log end error: {e}")
+                _LOG.error(f"Log end error: {e}")
             
             finally:
                 self._log_file = None
@@ -22,6 +22,7 @@ Or simpler - run as systemd service (see install instructions at bottom)
 """
 
 import os
+import re
 import sys
 import json
 import time
@@ -46,55 +47,64 @@ CONFIG = {
 }
 
 
+# "key: value" setting line; comments and [section] headers never match
+_CONFIG_LINE_RE = re.compile(r'\s*([A-Za-z_][A-Za-z0-9_]*)\s*:\s*(.*?)\s*$')
+
+# analysis_config.cfg keys used by the hook, and the CONFIG key each one sets
+_CONFIG_KEYS = {
+    'provider': 'provider',
+    'auto_apply': 'auto_apply',
+    'notify_console': 'notify_console',
+    'moonraker_url': 'moonraker_url',
+    'hook_mode': 'hook_mode',
+    'webhook_port': 'listen_port',
+}
+
+
+CONFIG_PATHS = (
+    os.path.join(os.path.dirname(__file__), 'analysis_config.cfg'),
+    os.path.expanduser('~/Klipper-Adaptive-Flow/analysis_config.cfg'),
+    os.path.expanduser('~/printer_data/config/analysis_config.cfg'),
+)
+
+
 def load_config_file():
     """Load settings from analysis_config.cfg if it exists."""
-    config_paths = [
-        os.path.join(os.path.dirname(__file__), 'analysis_config.cfg'),
-        os.path.expanduser('~/Klipper-Adaptive-Flow/analysis_config.cfg'),
-        os.path.expanduser('~/printer_data/config/analysis_config.cfg'),
-    ]
-    
-    for config_path in config_paths:
-        if os.path.exists(config_path):
-            try:
-                with open(config_path, 'r') as f:
-                    for line in f:
-                        line = line.strip()
-                        if not line or line.startswith('#') or line.startswith('['):
-                            continue
-                        if ':' in line:
-                            key, value = line.split(':', 1)
-                            key = key.strip()
-                            value = value.strip()
-                            
-                            if not value:
-                                continue
-                            
-                            # Parse booleans
-                            if value.lower() == 'true':
-                                value = True
-                            elif value.lower() == 'false':
-                                value = False
-                            elif value.isdigit():
-                                value = int(value)
-                            
-                            # Map config keys
-                            if key == 'provider':
-                                CONFIG['provider'] = value
-                            elif key == 'auto_apply':
-                                CONFIG['auto_apply'] = value
-                            elif key == 'notify_console':
-                                CONFIG['notify_console'] = value
-                            elif key == 'moonraker_url':
-                                CONFIG['moonraker_url'] = value
-                            elif key == 'hook_mode':
-                                CONFIG['hook_mode'] = value
-                            elif key == 'webhook_port' and isinstance(value, int):
-                                CONFIG['listen_port'] = value
-                
-                return config_path
-            except Exception as e:
-                pass  # Will log after logger is set up
+    for config_path in CONFIG_PATHS:
+        try:
+            f = open(config_path, 'r')
+        except OSError:
+            continue
+        try:
+            with f:
+                for line in f:
+                    match = _CONFIG_LINE_RE.match(line)
+                    if not match:
+                        continue
+                    key, value = match.groups()
+                    
+                    if not value:
+                        continue
+                    
+                    # Parse booleans
+                    lowered = value.lower()
+                    if lowered == 'true':
+                        value = True
+                    elif lowered == 'false':
+                        value = False
+                    elif value.isdigit():
+                        value = int(value)
+                    
+                    # Map config keys
+                    config_key = _CONFIG_KEYS.get(key)
+                    if config_key == 'listen_port' and not isinstance(value, int):
+                        continue
+                    if config_key:
+                        CONFIG[config_key] = value
+            
+            return config_path
+        except Exception as e:
+            pass  # Will log after logger is set up
     
     return None
 
@@ -377,10 +387,6 @@ Examples:
     CONFIG['provider'] = args.provider
     
     provider_str = args.provider or 'auto-detect from API key'
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    config_path = os.path.join(script_dir, 'analysis_config.cfg')
-    if os.path.exists(config_path):
-        logger.info(f"Config loaded from: {config_path}")
     logger.info(f"Starting Adaptive Flow hook (mode={args.mode}, provider={provider_str}, auto_apply={args.auto_apply})")
     
     if args.mode == 'webhook':
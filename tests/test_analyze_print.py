@@ -0,0 +1,104 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import analyze_print
+
+
+def write_print_csv(path, rows, peak=True):
+    """Write a monitor-style CSV with rows samples; pwm peaks at row 1234 if peak is set."""
+    with open(path, 'w') as f:
+        f.write(','.join(analyze_print.CSV_COLUMNS) + '\n')
+        for n in range(rows):
+            pwm = 0.99 if peak and n == 1234 else 0.5
+            f.write(f"{n}.0,220.0,225.0,1.0,8.00,150.0,{pwm},0.04,1.00,9.00,0,5000,60\n")
+
+
+class CsvSampleTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.csv_path = os.path.join(self.tmp.name, 'print.csv')
+        write_print_csv(self.csv_path, 5000)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def sample_times(self, max_rows):
+        lines = analyze_print.load_csv_sample(self.csv_path, max_rows).split('\n')
+        self.assertEqual(lines[0].split(',')[0], 'elapsed_s')
+        return [float(line.split(',')[0]) for line in lines[1:]]
+
+    def test_small_max_rows_keeps_end_of_print(self):
+        times = self.sample_times(5)
+        self.assertEqual(len(times), 5)
+        self.assertEqual(times[-4:], [4996.0, 4997.0, 4998.0, 4999.0])
+
+    def test_single_row_is_last_row(self):
+        self.assertEqual(self.sample_times(1), [4999.0])
+
+    def test_default_sample_has_start_peaks_and_end(self):
+        times = self.sample_times(100)
+        self.assertLessEqual(len(times), 100)
+        self.assertEqual(times[:10], [float(n) for n in range(10)])
+        self.assertEqual(times[-1], 4999.0)
+        self.assertIn(1234.0, times)
+        self.assertEqual(times, sorted(times))
+
+    def test_flat_columns_add_no_peak_rows(self):
+        write_print_csv(self.csv_path, 5000, peak=False)
+        analyze_print._load_csv_sample.cache_clear()
+        times = self.sample_times(100)
+        expected = list(range(10)) + list(range(4920, 5000))
+        self.assertEqual(times, [float(n) for n in expected])
+
+    def test_peak_rows_found_before_tail(self):
+        write_print_csv(self.csv_path, 1400)  # peak row 1234 is outside the last rows
+        analyze_print._load_csv_sample.cache_clear()
+        self.assertIn(1234.0, self.sample_times(50))
+
+
+class SimilarCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.config = dict(analyze_print.CONFIG)
+        analyze_print.CONFIG['log_dir'] = self.tmp.name
+        os.makedirs(os.path.join(self.tmp.name, '.cache'))
+
+    def tearDown(self):
+        analyze_print.CONFIG.clear()
+        analyze_print.CONFIG.update(self.config)
+        self.tmp.cleanup()
+
+    def full_summary(self):
+        summary = {name: 10.0 for name in analyze_print.SIMILAR_FEATURES}
+        summary['material'] = 'PLA'
+        return summary
+
+    def cache(self, key, summary):
+        analyze_print.save_cached_response(key, 'cached analysis')
+        analyze_print.index_similar_response(key, summary)
+
+    def test_full_summaries_match(self):
+        self.cache('a' * 64, self.full_summary())
+        self.assertEqual(analyze_print.find_similar_response(self.full_summary()), 'cached analysis')
+
+    def test_sparse_summaries_do_not_match(self):
+        sparse = {'material': 'PLA', 'duration_min': 10.0}
+        self.cache('b' * 64, sparse)
+        self.assertIsNone(analyze_print.find_similar_response(dict(sparse)))
+        self.assertIsNone(analyze_print.find_similar_response(self.full_summary()))
+
+    def test_missing_field_is_dissimilar(self):
+        full = self.full_summary()
+        partial = dict(full)
+        del partial['fan_avg']
+        self.assertEqual(analyze_print._similarity(full, full), 1.0)
+        self.assertEqual(analyze_print._similarity(full, partial), 0.0)
+        self.assertEqual(analyze_print._similarity(partial, partial), 0.0)
+
+
+if __name__ == '__main__':
+    unittest.main()